@@ -1,24 +1,262 @@
 # app.py
-from flask import Flask, render_template_string, jsonify, request
-import requests, json, re, pytz
+from flask import Flask, render_template_string, jsonify, request, g
+import click
+import requests, json, re, pytz, os, sys, threading, gzip, tempfile, multiprocessing, hashlib, base64, hmac, random, cProfile
+import time as _time
 from icalendar import Calendar
+from icalendar.parser import Contentline
+from icalendar.prop import vText
+from icalendar.timezone import tzp
 from datetime import datetime, date, time, timedelta
-from collections import defaultdict
+from array import array
+from collections import defaultdict, OrderedDict, deque
+from bisect import bisect_left, bisect_right
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache, wraps
+from typing import NamedTuple
+
+try:
+    import fcntl  # POSIX only; without it the snapshot file is not shared across workers
+except ImportError:
+    fcntl = None
+
+try:
+    import numpy as np  # optional: batched trade-options engine
+except ImportError:
+    np = None
 
 app = Flask(__name__)
 
-# Load calendars config
-with open("calendars.json") as f:
+# Load calendars config (CALENDARS_PATH points benchmarks / load tests elsewhere)
+with open(os.environ.get("CALENDARS_PATH", "calendars.json")) as f:
     calendars = json.load(f)
 
 EASTERN = pytz.timezone("America/New_York")
 
+# Trade-options engine: "vector" (NumPy, batched), "scalar" (simulate_swap_ok
+# per candidate) or "auto" (vector when NumPy is installed). With
+# TRADE_ENGINE_PARITY=1 every request runs both and logs any disagreement.
+_TRADE_ENGINE = os.environ.get("TRADE_ENGINE", "auto")
+_TRADE_ENGINE_PARITY = os.environ.get("TRADE_ENGINE_PARITY") == "1"
+
+# All-pairs trade matrix (dashboards): built in a background thread once per
+# snapshot version (versions only change with the shifts), sharded across a
+# fork()ed process pool that inherits the snapshot read-only (shard code takes
+# no locks, so the threads it was forked from don't matter). Requests are
+# served the last finished matrix and never wait for a build. With a snapshot
+# file, one worker builds (flock on <snapshot>.matrix.lock) and writes
+# <snapshot>.matrix; the others adopt it. The pool defaults to half the CPUs.
+_MATRIX_WORKERS = int(os.environ.get("TRADE_MATRIX_WORKERS", "0")) or max(1, (os.cpu_count() or 1) // 2)
+_MATRIX_LOCK = threading.Lock()
+_MATRIX = None
+_MATRIX_BUILDING = False
+_MATRIX_SNAP = None  # snapshot visible to forked pool workers
+_MATRIX_FORMAT = 1
+_MATRIX_ADOPT_POLL_SECONDS = 2  # while another worker builds
+
+# Memoized /trade-options results, keyed by (snapshot version, trader_shift_id).
+# LRU-bounded; cleared whenever a new snapshot is installed.
+_OPTIONS_CACHE_SIZE = 512
+_OPTIONS_CACHE = OrderedDict()
+_OPTIONS_LOCK = threading.Lock()
+_OPTIONS_STATS = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+
+# Per-install change log for /shifts/delta: each entry holds the shifts added
+# and removed between two consecutive snapshot versions. Bounded; clients whose
+# version has fallen off the end are told to resync from /shifts.json.
+_CHANGE_LOG_SIZE = 64
+_CHANGE_LOG = deque(maxlen=_CHANGE_LOG_SIZE)
+
+# /shifts/stream: open tabs wait on this condition, which install_snapshot()
+# notifies, and get each delta pushed to them instead of polling. Each stream
+# holds a server thread, so run with threads to spare (see gunicorn.conf.py);
+# past SHIFT_STREAM_MAX_CLIENTS per process tabs get 204 and poll
+# /shifts/delta instead.
+_SNAPSHOT_CHANGED = threading.Condition()
+_STREAM_HEARTBEAT_SECONDS = 25
+_STREAM_MAX_SECONDS = 30 * 60  # then the browser reconnects with Last-Event-ID
+_STREAM_MAX_CLIENTS = int(os.environ.get("SHIFT_STREAM_MAX_CLIENTS", "8"))
+_STREAM_CATCH_UP_SECONDS = 2  # retry interval while a client is ahead of this worker
+_STREAMS_LOCK = threading.Lock()
+_STREAMS_OPEN = 0
+
+# Opt-in cProfile capture of /trade-options and /trade-recheck: per request
+# with X-Profile-Token (or ?profile=) matching PROFILE_ADMIN_TOKEN, or for a
+# PROFILE_SAMPLE_RATE fraction of traffic. Dumps go to PROFILE_DIR, newest
+# PROFILE_KEEP kept. One capture at a time; concurrent requests run unprofiled.
+_PROFILE_TOKEN = os.environ.get("PROFILE_ADMIN_TOKEN") or None
+_PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", "0") or 0)
+_PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")
+_PROFILE_KEEP = int(os.environ.get("PROFILE_KEEP", "50"))
+_PROFILE_LOCK = threading.Lock()
+
 # -------------------------------------------------
 # Small in-memory cache to speed repeated requests
 # -------------------------------------------------
 _CACHE = None
 _CACHE_TTL_SECONDS = 120  # adjust as desired
 
+# Background refresh: a daemon thread rebuilds the snapshot shortly before it
+# expires, so requests never pay for the upstream fetch. Requests that see an
+# expired snapshot keep getting it (stale-while-revalidate) and just nudge the
+# refresher. A failed refresh keeps the last good snapshot and records the error.
+_BACKGROUND_REFRESH = os.environ.get("SHIFT_BG_REFRESH", "1") != "0"
+_REFRESH_AHEAD_SECONDS = 20
+_REFRESH_RETRY_SECONDS = 15
+_REFRESH_WAKE = threading.Event()
+_REFRESHER = None
+_LAST_REFRESH_ERROR = None  # {"at": datetime, "error": str} while refreshes are failing
+
+# Last good snapshot is persisted here (gzipped JSON) after every refresh and
+# loaded on a cold start, so a restart serves a file read instead of N fetches
+# and then revalidates in the background (conditional GETs included).
+_SNAPSHOT_PATH = os.environ.get("SHIFT_SNAPSHOT_PATH", "shift_snapshot.json.gz")
+_SNAPSHOT_FORMAT = 3  # 3: rows no longer carry eligible
+_SNAPSHOT_MAX_AGE_SECONDS = 6 * 3600  # older files are ignored on startup
+
+# The same file doubles as the cross-worker cache: every snapshot carries a
+# version stamp, one gunicorn worker at a time refreshes (flock on
+# <snapshot>.lock) and the others install the file it wrote instead of
+# refetching. _SHARED_FILE_SIG is the (mtime, size, inode) we last looked at.
+_SHARED_FILE_SIG = None
+
+# Single-flight: only one thread rebuilds at a time. Callers that arrive while
+# a rebuild is in flight either wait for its result (nothing to serve yet) or
+# take the stale snapshot, instead of each hitting upstream themselves.
+_REFRESH_LOCK = threading.Lock()
+_STATS_LOCK = threading.Lock()
+_CACHE_STATS = {
+    "refreshes": 0,
+    "refresh_failures": 0,
+    "coalesced_waits": 0,   # blocked on another thread's rebuild and reused its result
+    "coalesced_stale": 0,   # served the stale snapshot while another thread rebuilt
+    "shared_loads": 0,      # installed a snapshot another worker wrote to disk
+}
+
+def _bump(counter, n=1):
+    with _STATS_LOCK:
+        _CACHE_STATS[counter] += n
+
+# Calendars are fetched in parallel through a small bounded pool, so a cold
+# load costs roughly the slowest feed instead of the sum of all of them.
+_FETCH_WORKERS = 8
+_FETCH_TIMEOUT_SECONDS = 12
+_LAST_FETCH_STATS = []  # per-calendar latency of the most recent fetch
+
+# Per-feed validators and already-parsed shifts, keyed by (name, url).
+# Lets a refresh send If-None-Match / If-Modified-Since and reuse the parsed
+# shifts when QGenda answers 304 Not Modified.
+_FEED_STATE = {}
+
+
+# -------------------------------
+# Metrics (Prometheus text at /metrics)
+# -------------------------------
+# Counters and histograms keyed by (name, sorted label pairs). Recording is
+# a dict update under one lock; exposition formats everything on scrape.
+_METRICS_LOCK = threading.Lock()
+_COUNTERS = defaultdict(float)
+_HISTOGRAMS = {}  # key -> [bucket bounds, per-bucket counts..., +Inf count, sum]
+_HISTOGRAM_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+_COUNT_BUCKETS = (10, 100, 1000, 10000, 100000)
+_METRIC_HELP = {
+    "tradeapp_http_request_seconds": "Route latency until the response object is ready.",
+    "tradeapp_feed_fetch_seconds": "Upstream iCal fetch time per calendar.",
+    "tradeapp_feed_parse_seconds": "Parse time per calendar body, by stage.",
+    "tradeapp_feed_parse_fallbacks_total": "Feeds the streaming reader handed to the full iCal parser, by reason.",
+    "tradeapp_feed_responses_total": "Upstream responses per calendar and status.",
+    "tradeapp_feed_bytes_total": "iCal body bytes received per calendar.",
+    "tradeapp_feed_events_seen_total": "VEVENTs found per calendar.",
+    "tradeapp_feed_events_kept_total": "VEVENTs kept as future shifts per calendar.",
+    "tradeapp_refresh_stage_seconds": "Snapshot rebuild time by stage.",
+    "tradeapp_refresh_people_total": "People whose schedule index was reused or rebuilt on install.",
+    "tradeapp_refresh_total": "Installed snapshots, by whether their shifts changed.",
+    "tradeapp_snapshot_loads_total": "load_snapshot() calls by what they found.",
+    "tradeapp_encode_seconds": "Response serialization time.",
+    "tradeapp_trade_evaluations_total": "Swap candidates evaluated, by engine.",
+    "tradeapp_trade_evaluations_per_computation": "Swap pairs evaluated per trade-options computation; cache hits compute nothing (see tradeapp_trade_options_cache_total).",
+    "tradeapp_trade_rechecks_total": "simulate_swap_ok() rechecks by reason.",
+    "tradeapp_trade_matrix_build_seconds": "Background all-pairs trade matrix builds.",
+    "tradeapp_trade_matrix_adopted_total": "Trade matrices taken from the shared file another worker built.",
+    "tradeapp_profiles_total": "Requests captured by the profiling hook.",
+    "tradeapp_streams_refused_total": "/shifts/stream requests answered 204 because the stream cap was reached.",
+}
+
+
+def _metric_key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+def metric_inc(name, n=1, **labels):
+    with _METRICS_LOCK:
+        _COUNTERS[_metric_key(name, labels)] += n
+
+def metric_observe(name, value, buckets=_HISTOGRAM_BUCKETS, **labels):
+    key = _metric_key(name, labels)
+    i = bisect_left(buckets, value)
+    with _METRICS_LOCK:
+        h = _HISTOGRAMS.get(key)
+        if h is None:
+            h = _HISTOGRAMS[key] = [buckets] + [0] * (len(buckets) + 2)
+        h[1 + i] += 1
+        h[-1] += value
+
+@contextmanager
+def metric_timer(name, **labels):
+    t0 = _time.perf_counter()
+    try:
+        yield
+    finally:
+        metric_observe(name, _time.perf_counter() - t0, **labels)
+
+def _prom_escape(v):
+    return str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _prom_labels(pairs, extra=()):
+    pairs = tuple(pairs) + tuple(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join('%s="%s"' % (k, _prom_escape(v)) for k, v in pairs) + "}"
+
+def render_metrics(extra_counters=(), gauges=()):
+    """
+    Prometheus text exposition of everything recorded, plus
+    `extra_counters` / `gauges` given as (name, help, labels dict, value).
+    """
+    with _METRICS_LOCK:
+        counters = sorted(_COUNTERS.items())
+        hists = sorted((k, list(v)) for k, v in _HISTOGRAMS.items())
+    lines = []
+    seen = set()
+
+    def header(name, kind, text):
+        if name not in seen:
+            seen.add(name)
+            lines.append("# HELP %s %s" % (name, text))
+            lines.append("# TYPE %s %s" % (name, kind))
+
+    for (name, labels), value in counters:
+        header(name, "counter", _METRIC_HELP.get(name, name))
+        lines.append("%s%s %s" % (name, _prom_labels(labels), repr(float(value))))
+    for name, text, labels, value in extra_counters:
+        header(name, "counter", text)
+        lines.append("%s%s %s" % (name, _prom_labels(sorted(labels.items())), repr(float(value))))
+    for name, text, labels, value in gauges:
+        header(name, "gauge", text)
+        lines.append("%s%s %s" % (name, _prom_labels(sorted(labels.items())), repr(float(value))))
+    for (name, labels), h in hists:
+        header(name, "histogram", _METRIC_HELP.get(name, name))
+        buckets, counts, total = h[0], h[1:-1], h[-1]
+        cum = 0
+        for le, c in zip(buckets, counts):
+            cum += c
+            lines.append("%s_bucket%s %d" % (name, _prom_labels(labels, [("le", repr(float(le)))]), cum))
+        cum += counts[-1]
+        lines.append("%s_bucket%s %d" % (name, _prom_labels(labels, [("le", "+Inf")]), cum))
+        lines.append("%s_sum%s %s" % (name, _prom_labels(labels), repr(float(total))))
+        lines.append("%s_count%s %d" % (name, _prom_labels(labels), cum))
+    return "\n".join(lines) + "\n"
+
 
 # -------------------------------
 # Datetime helpers
@@ -46,6 +284,70 @@ def future_cutoff():
     start_of_today = now_et.replace(hour=0, minute=0, second=0, microsecond=0)
     return start_of_today + timedelta(days=1)
 
+def to_minutes(dt):
+    """Aware datetime -> integer minutes since the epoch."""
+    return int(dt.timestamp()) // 60
+
+def from_minutes(m):
+    return datetime.fromtimestamp(m * 60, EASTERN)
+
+@lru_cache(maxsize=65536)
+def minutes_iso(m):
+    return from_minutes(m).isoformat()
+
+def week_start_minutes(m):
+    """Monday 00:00 (Eastern) of the week containing minute `m`, in epoch minutes."""
+    # Eastern offsets are whole hours, so the local week is constant per UTC hour
+    return _week_start_for_hour(m // 60)
+
+@lru_cache(maxsize=16384)
+def _week_start_for_hour(h):
+    local_day = from_minutes(h * 60).date()
+    monday = local_day - timedelta(days=local_day.weekday())  # Monday=0
+    # localize() picks the offset in force at that midnight, so every shift of
+    # a DST-change week lands in the same bucket
+    return to_minutes(EASTERN.localize(datetime.combine(monday, time(0, 0))))
+
+
+# -------------------------------
+# Shift record
+# -------------------------------
+class Shift(NamedTuple):
+    """
+    One shift. A tuple instead of a dict keeps per-shift memory small across
+    long horizons; person/title are interned and start/end are integer epoch
+    minutes (end exclusive). `week` is the Monday 00:00 ET of the start's
+    week, also in epoch minutes, for the weekly-cap buckets.
+    """
+    id: str
+    person: str
+    title: str
+    start: int
+    end: int
+    eligible: bool
+    week: int
+
+def shift_id(person, start, end, title):
+    return f"{person}|{minutes_iso(start)}|{minutes_iso(end)}|{title}"
+
+def make_shift(person, title, start, end, eligible=None):
+    if eligible is None:
+        eligible = is_eligible_title(title)
+    person = sys.intern(person)
+    title = sys.intern(title)
+    return Shift(shift_id(person, start, end, title), person, title, start, end, eligible,
+                 week_start_minutes(start))
+
+def shift_json(s):
+    return {
+        "id": s.id,
+        "person": s.person,
+        "title": s.title,
+        "start": minutes_iso(s.start),
+        "end": minutes_iso(s.end),
+        "eligible": s.eligible,
+    }
+
 
 # -------------------------------
 # Eligibility rules
@@ -82,75 +384,880 @@ def is_eligible_title(title: str) -> bool:
     return any(rx.search(title) for rx in ALLOW_REGEXES)
 
 
+# -------------------------------
+# Calendar fetching (parallel, bounded)
+# -------------------------------
+def _feed_key(cal):
+    return (cal["name"], cal["url"])
+
+def fetch_calendar(cal, start_cutoff=None):
+    """
+    Fetch one iCal feed, conditionally when we already hold a parsed copy.
+    Returns (body text, elapsed seconds, response headers); body is None when
+    upstream answered 304 and the cached shifts for this feed are still usable.
+    """
+    headers = {}
+    state = _FEED_STATE.get(_feed_key(cal))
+    # Cached shifts were filtered at their own cutoff; they can only be
+    # reused for the same or a later cutoff.
+    if state and (start_cutoff is None or state["cutoff"] <= start_cutoff):
+        if state.get("etag"):
+            headers["If-None-Match"] = state["etag"]
+        if state.get("last_modified"):
+            headers["If-Modified-Since"] = state["last_modified"]
+
+    t0 = _time.perf_counter()
+    try:
+        resp = requests.get(cal["url"], headers=headers or None, timeout=_FETCH_TIMEOUT_SECONDS)
+    except requests.RequestException:
+        metric_inc("tradeapp_feed_responses_total", calendar=cal["name"], status="error")
+        raise
+    elapsed = _time.perf_counter() - t0
+    metric_observe("tradeapp_feed_fetch_seconds", elapsed, calendar=cal["name"])
+    metric_inc("tradeapp_feed_responses_total", calendar=cal["name"], status=resp.status_code)
+    metric_inc("tradeapp_feed_bytes_total", len(resp.content), calendar=cal["name"])
+    if resp.status_code == 304 and headers:
+        return None, elapsed, resp.headers
+    resp.raise_for_status()
+    return resp.text, elapsed, resp.headers
+
+def fetch_all_calendars(cals, start_cutoff=None):
+    """
+    Fetch every feed through a bounded thread pool.
+    Results come back in the same order as `cals`, whatever order they finish in.
+    """
+    if not cals:
+        return []
+    workers = max(1, min(_FETCH_WORKERS, len(cals)))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ical-fetch") as pool:
+        return list(pool.map(lambda cal: fetch_calendar(cal, start_cutoff), cals))
+
+
 # -------------------------------
 # Normalize all shifts (FUTURE ONLY: start >= tomorrow 00:00 ET)
 # -------------------------------
-def normalize_shifts(start_cutoff=None):
+class _FullParseNeeded(Exception):
+    """The streaming reader met something only Calendar.from_ical handles exactly."""
+
+
+_ICAL_LINE = re.compile(r"[^\n]+")
+_ICAL_PROP = re.compile(r"([A-Za-z0-9-]+)[;:]")
+_ICAL_DATETIME = re.compile(r"\d{8}(?:T\d{6}Z?)?$")
+# Properties that change which instances exist or how long they run
+_ICAL_FULL_PARSE_PROPS = {"RRULE", "RDATE", "EXRULE", "EXDATE", "RECURRENCE-ID", "DURATION"}
+
+
+def parse_calendar_shifts(name, body, start_cutoff):
+    """
+    Parse one iCal body into Shifts for `name`, keeping starts >= cutoff.
+    Uses the streaming reader, and the full parser when the feed has
+    anything the reader does not model.
+    """
+    try:
+        return stream_calendar_shifts(name, body, start_cutoff)
+    except _FullParseNeeded as e:
+        metric_inc("tradeapp_feed_parse_fallbacks_total", calendar=name, reason=str(e))
+        return full_parse_calendar_shifts(name, body, start_cutoff)
+
+
+def _ical_value_minutes(line, value, tz_cache):
+    """DTSTART/DTEND content line -> epoch minutes, the way Calendar.from_ical reads it."""
+    if len(value) == 8:
+        dt = date(int(value[:4]), int(value[4:6]), int(value[6:8]))
+    else:
+        dt = datetime(int(value[:4]), int(value[4:6]), int(value[6:8]),
+                      int(value[9:11]), int(value[11:13]), int(value[13:15]))
+        tzid = None
+        for param in line[:line.index(":")].split(";")[1:]:
+            key, _, val = param.partition("=")
+            if key.upper() == "TZID":
+                tzid = val
+        if tzid is not None:
+            tz = tz_cache.get(tzid)
+            if tz is None:
+                tz = tz_cache[tzid] = tzp.timezone(tzid)
+                if tz is None:
+                    raise _FullParseNeeded("tzid")  # may be defined by a VTIMEZONE
+            dt = tzp.localize(dt, tz)
+        elif len(value) == 16:
+            dt = tzp.localize_utc(dt)
+    return to_minutes(to_eastern(dt))
+
+
+def _ical_summary(line):
+    if line is None:
+        return ""
+    if '"' in line or "\\" in line or "%" in line:
+        # escapes / quoted params: let icalendar unescape it exactly
+        return str(vText.from_ical(Contentline(line).parts()[2]) or "")
+    return line[line.index(":") + 1:]
+
+
+def stream_calendar_shifts(name, body, start_cutoff):
+    """
+    Line-by-line VEVENT reader: unfolds content lines, keeps only DTSTART,
+    DTEND and SUMMARY, and drops events whose start date is well before the
+    cutoff without parsing them further. No component tree is built, so
+    work and memory beyond the raw body follow the future events.
+    Raises _FullParseNeeded for recurrence, DURATION, unknown TZIDs,
+    quoted parameters, nesting it does not expect or malformed input.
+    """
+    out = []
+    cutoff = to_minutes(start_cutoff)
+    # Any timezone's local date is within a day of Eastern's
+    skip_before = (start_cutoff.astimezone(EASTERN).date() - timedelta(days=2)).strftime("%Y%m%d")
+    t0 = _time.perf_counter()
+    tz_cache = {}
+    stack = []
+    event = None
+    seen = 0
+    tops = 0
+
+    def logical_lines():
+        pending = None
+        for m in _ICAL_LINE.finditer(body):
+            line = m.group().rstrip("\r")
+            if not line:
+                continue
+            if line[0] in " \t" and pending is not None:
+                pending += line[1:]
+                continue
+            if pending is not None:
+                yield pending
+            pending = line
+        if pending is not None:
+            yield pending
+
+    for line in logical_lines():
+        m = _ICAL_PROP.match(line)
+        if m is None or ":" not in line:
+            raise _FullParseNeeded("syntax")
+        prop = m.group(1).upper()
+
+        if prop == "BEGIN" or prop == "END":
+            if m.group()[-1] != ":":
+                raise _FullParseNeeded("syntax")
+            comp = line[m.end():].upper()
+            if prop == "BEGIN":
+                if not stack:
+                    tops += 1
+                    if tops > 1 or comp != "VCALENDAR":
+                        raise _FullParseNeeded("structure")
+                elif stack[-1] == "VEVENT" and comp != "VALARM":
+                    raise _FullParseNeeded("structure")
+                elif comp == "VEVENT":
+                    if len(stack) != 1:
+                        raise _FullParseNeeded("structure")
+                    event = {}
+                stack.append(comp)
+                continue
+            if not stack or stack.pop() != comp:
+                raise _FullParseNeeded("structure")
+            if comp != "VEVENT":
+                continue
+
+            seen += 1
+            dtstart, dtend = event.get("DTSTART"), event.get("DTEND")
+            if dtstart is None or dtend is None:
+                raise _FullParseNeeded("missing-dt")
+            start_value = dtstart[dtstart.index(":") + 1:]
+            end_value = dtend[dtend.index(":") + 1:]
+            if not (_ICAL_DATETIME.match(start_value) and _ICAL_DATETIME.match(end_value)):
+                raise _FullParseNeeded("value")
+            if start_value[:8] < skip_before:
+                continue  # long past: skipped unparsed
+
+            start = _ical_value_minutes(dtstart, start_value, tz_cache)
+            end = _ical_value_minutes(dtend, end_value, tz_cache)  # exclusive by spec
+            if end <= start or start < cutoff:
+                continue
+            out.append(make_shift(name, _ical_summary(event.get("SUMMARY")), start, end))
+            continue
+
+        if not stack:
+            raise _FullParseNeeded("structure")
+        if stack[-1] != "VEVENT":
+            continue
+        if prop in ("DTSTART", "DTEND", "SUMMARY"):
+            if prop in event:
+                raise _FullParseNeeded("duplicate")
+            if prop != "SUMMARY" and '"' in line:
+                raise _FullParseNeeded("params")
+            event[prop] = line
+        elif prop in _ICAL_FULL_PARSE_PROPS:
+            raise _FullParseNeeded(prop.lower())
+
+    if stack or not tops:
+        raise _FullParseNeeded("structure")
+
+    metric_observe("tradeapp_feed_parse_seconds", _time.perf_counter() - t0, calendar=name, stage="stream")
+    metric_inc("tradeapp_feed_events_seen_total", seen, calendar=name)
+    metric_inc("tradeapp_feed_events_kept_total", len(out), calendar=name)
+    return out
+
+
+def full_parse_calendar_shifts(name, body, start_cutoff):
+    """Parse one iCal body with Calendar.from_ical + walk(), keeping starts >= cutoff."""
+    out = []
+    cutoff = to_minutes(start_cutoff)
+    t0 = _time.perf_counter()
+    cal_obj = Calendar.from_ical(body)
+    t1 = _time.perf_counter()
+    seen = 0
+
+    for comp in cal_obj.walk():
+        if comp.name != "VEVENT":
+            continue
+        seen += 1
+
+        start = to_minutes(to_eastern(comp.decoded("dtstart")))
+        end = to_minutes(to_eastern(comp.decoded("dtend")))  # exclusive by spec
+        if end <= start:
+            continue
+
+        # Only future shifts whose START >= cutoff
+        if start < cutoff:
+            continue
+
+        title = str(comp.get("summary", "") or "")
+        out.append(make_shift(name, title, start, end))
+
+    metric_observe("tradeapp_feed_parse_seconds", t1 - t0, calendar=name, stage="from_ical")
+    metric_observe("tradeapp_feed_parse_seconds", _time.perf_counter() - t1, calendar=name, stage="walk")
+    metric_inc("tradeapp_feed_events_seen_total", seen, calendar=name)
+    metric_inc("tradeapp_feed_events_kept_total", len(out), calendar=name)
+    return out
+
+
+# -------------------------------
+# Parser parity (flask check-parse)
+# -------------------------------
+def _parse_outcome(fn, name, body, cutoff):
+    """Shifts, or the exception type name when `fn` rejects the feed."""
+    try:
+        return fn(name, body, cutoff)
+    except Exception as e:
+        return type(e).__name__
+
+
+def check_parse_parity(feeds, cutoffs=None):
+    """
+    Parse every {label: body} feed at each cutoff with parse_calendar_shifts()
+    and with full_parse_calendar_shifts(). A feed both parsers reject with
+    the same error agrees. Returns one dict per (feed, cutoff) with the path
+    taken ("stream" or the fallback reason), both outcomes and whether they
+    match. Edge-case feeds and DST cutoffs live in bench/parse_cases.py.
+    """
+    if cutoffs is None:
+        cutoffs = [future_cutoff()]
+    rows = []
+    for label, body in feeds.items():
+        for cutoff in cutoffs:
+            try:
+                stream_calendar_shifts(label, body, cutoff)
+                path = "stream"
+            except _FullParseNeeded as e:
+                path = "full:%s" % e
+            except Exception as e:
+                path = "stream-error:%s" % type(e).__name__
+            got = _parse_outcome(parse_calendar_shifts, label, body, cutoff)
+            expected = _parse_outcome(full_parse_calendar_shifts, label, body, cutoff)
+            rows.append({"feed": label, "cutoff": cutoff, "path": path, "got": got,
+                         "expected": expected, "ok": got == expected})
+    return rows
+
+
+def parse_parity_report(rows):
+    """Text lines for check_parse_parity() rows, ending with the mismatch count."""
+    lines = []
+    for r in rows:
+        if r["ok"]:
+            n = len(r["got"]) if isinstance(r["got"], list) else r["got"]
+            lines.append("ok        %-20s %s  %-18s %s" % (r["feed"], r["cutoff"].date(), r["path"], n))
+            continue
+        lines.append("MISMATCH  %-20s %s  %-18s" % (r["feed"], r["cutoff"].date(), r["path"]))
+        got, expected = r["got"], r["expected"]
+        if isinstance(got, list) and isinstance(expected, list):
+            got = [s for s in got if s not in expected][:3]
+            expected = [s for s in r["expected"] if s not in r["got"]][:3]
+        lines.append("    stream: %s\n    full:   %s" % (got, expected))
+    lines.append("%d mismatches in %d checks" % (sum(1 for r in rows if not r["ok"]), len(rows)))
+    return lines
+
+
+@app.cli.command("check-parse")
+@click.argument("paths", nargs=-1, type=click.Path(exists=True, dir_okay=False))
+@click.option("--live", is_flag=True, help="Also fetch and check the configured calendars.")
+def check_parse_command(paths, live):
+    """Prove the streaming iCal reader agrees with Calendar.from_ical on .ics files and live feeds."""
+    if not paths and not live:
+        raise click.UsageError("give .ics files and/or --live (edge cases: python bench/parse_cases.py)")
+    feeds = {}
+    for path in paths:
+        with open(path, encoding="utf-8", newline="") as f:
+            feeds[path] = f.read()
+    if live:
+        for cal, (body, _, _) in zip(calendars, fetch_all_calendars(calendars)):
+            if body is not None:
+                feeds[cal["name"]] = body
+    rows = check_parse_parity(feeds)
+    for line in parse_parity_report(rows):
+        click.echo(line)
+    if not all(r["ok"] for r in rows):
+        raise SystemExit(1)
+
+
+def group_schedules(flat):
+    """person -> that person's shifts sorted by start."""
+    schedules = defaultdict(list)
+    for s in flat:
+        schedules[s.person].append(s)
+    for p in schedules:
+        schedules[p].sort(key=lambda x: x.start)
+    return schedules
+
+
+def normalize_shifts(start_cutoff=None, previous=None):
     """
     Returns:
       people: list[str]
-      flat: list[shift dict]  (future-only)
-      schedules: dict[str, list[shift]]
-    Shift dict:
-      { id, person, title, start, end, eligible }
+      flat: list[Shift]  (future-only)
+      schedules: dict[str, list[Shift]]  (each sorted by start)
+
+    Feeds whose bytes hash the same as last time (or that answered 304) are
+    not re-parsed. With `previous`, the snapshot built at the same cutoff,
+    people whose feeds are all unchanged keep its schedule lists as-is, so
+    install_snapshot() can reuse their indexes too.
     """
     if start_cutoff is None:
         start_cutoff = future_cutoff()
 
     flat = []
     names = []
+    fetch_stats = []
+    per_feed = []      # (person, shifts) in calendar order
+    changed = set()    # people with at least one re-parsed feed
+    parsed = {}        # new _FEED_STATE entries, applied only once every feed parsed
 
-    for cal in calendars:
-        names.append(cal["name"])
-        resp = requests.get(cal["url"], timeout=12)
-        resp.raise_for_status()
-        cal_obj = Calendar.from_ical(resp.text)
+    with metric_timer("tradeapp_refresh_stage_seconds", stage="fetch"):
+        fetched = fetch_all_calendars(calendars, start_cutoff)
 
-        for comp in cal_obj.walk():
-            if comp.name != "VEVENT":
-                continue
+    for cal, (body, elapsed, headers) in zip(calendars, fetched):
+        names.append(cal["name"])
+        key = _feed_key(cal)
+        state = _FEED_STATE.get(key)
+        digest = None
+        if body is not None:
+            digest = hashlib.sha1(body.encode("utf-8")).hexdigest()
+            if not (state and state.get("hash") == digest and state["cutoff"] <= start_cutoff):
+                state = None
+        if state is not None:
+            # 304 or identical bytes: reuse the shifts parsed on an earlier refresh
+            cutoff = to_minutes(start_cutoff)
+            shifts = [s for s in state["shifts"] if s.start >= cutoff]
+            if body is not None:
+                state["etag"] = headers.get("ETag")
+                state["last_modified"] = headers.get("Last-Modified")
+            status = 304 if body is None else 200
+        else:
+            shifts = parse_calendar_shifts(cal["name"], body, start_cutoff)
+            parsed[key] = {
+                "etag": headers.get("ETag"),
+                "last_modified": headers.get("Last-Modified"),
+                "cutoff": start_cutoff,
+                "hash": digest,
+                "shifts": shifts,
+            }
+            changed.add(cal["name"])
+            status = 200
+        fetch_stats.append({
+            "name": cal["name"],
+            "ms": round(elapsed * 1000.0, 1),
+            "status": status,
+            "parsed": state is None,
+            "shifts": len(shifts),
+        })
+        per_feed.append((cal["name"], shifts))
+        flat.extend(shifts)
+    # A half-finished refresh must not leave state newer than the installed snapshot
+    _FEED_STATE.update(parsed)
+
+    with metric_timer("tradeapp_refresh_stage_seconds", stage="group"):
+        if previous is not None and previous["cutoff"] == start_cutoff:
+            schedules = splice_schedules(previous["schedules"], per_feed, changed)
+        else:
+            schedules = group_schedules(flat)
 
-            start = to_eastern(comp.decoded("dtstart"))
-            end = to_eastern(comp.decoded("dtend"))  # exclusive by spec
-            if end <= start:
-                continue
+    _LAST_FETCH_STATS[:] = fetch_stats
+    if fetch_stats:
+        slowest = max(fetch_stats, key=lambda x: x["ms"])
+        app.logger.info("fetched %d calendars; slowest %s (%.1f ms)",
+                        len(fetch_stats), slowest["name"], slowest["ms"])
 
-            # Only future shifts whose START >= cutoff
-            if start < start_cutoff:
-                continue
+    people = sorted(set(names))
+    return people, flat, schedules
 
-            title = str(comp.get("summary", "") or "")
-            shift = {
-                "id": f'{cal["name"]}|{iso(start)}|{iso(end)}|{title}',
-                "person": cal["name"],
-                "title": title,
-                "start": start,
-                "end": end,
-                "eligible": is_eligible_title(title),
-            }
-            flat.append(shift)
 
+def splice_schedules(prev_schedules, per_feed, changed):
+    """
+    group_schedules() of the concatenated feeds, reusing the previous
+    snapshot's list for every person not in `changed`; only changed people
+    are regrouped and re-sorted. Keys keep first-appearance order.
+    """
+    totals = defaultdict(int)
+    for person, shifts in per_feed:
+        totals[person] += len(shifts)
     schedules = defaultdict(list)
-    for s in flat:
-        schedules[s["person"]].append(s)
-    for p in schedules:
-        schedules[p].sort(key=lambda x: x["start"])
+    fresh = set()
+    for person, shifts in per_feed:
+        if not shifts:
+            continue
+        if person not in changed and len(prev_schedules.get(person, ())) == totals[person]:
+            if person not in schedules:
+                schedules[person] = prev_schedules[person]
+            continue
+        schedules[person].extend(shifts)
+        fresh.add(person)
+    for p in fresh:
+        schedules[p].sort(key=lambda x: x.start)
+    return schedules
 
-    people = sorted(set(names))
-    return people, flat, schedules
 
+def snapshot_age_seconds(snap=None):
+    snap = _CACHE if snap is None else snap
+    if snap is None:
+        return None
+    return (datetime.now(EASTERN) - snap["ts"]).total_seconds()
 
-def load_data_cached():
-    """Return (people, flat, schedules), using a short-lived in-memory cache."""
+
+def refresh_cache(raise_errors=False, wait=True):
+    """
+    Rebuild the snapshot from upstream and install it (single-flight).
+    If another thread is already rebuilding, wait for its result, or return
+    straight away when `wait` is False. On failure the previous snapshot stays
+    in place and the error is recorded (or raised when `raise_errors` is set
+    and there is nothing to serve). Returns True when a fresh snapshot is in place.
+    """
+    while not _REFRESH_LOCK.acquire(blocking=False):
+        if not wait:
+            _bump("coalesced_stale")
+            return False
+        _bump("coalesced_waits")
+        with _REFRESH_LOCK:
+            pass
+        err = _LAST_REFRESH_ERROR
+        if _CACHE is None and err is None:
+            continue  # the holder only looked for a snapshot file; rebuild ourselves
+        if raise_errors and _CACHE is None:
+            raise RuntimeError("shift refresh failed: %s" % (err["error"] if err else "unknown error"))
+        return err is None
+
+    try:
+        return _refresh_locked(raise_errors, wait)
+    finally:
+        _REFRESH_LOCK.release()
+
+
+def _refresh_locked(raise_errors, wait):
+    global _LAST_REFRESH_ERROR
+    # Lost a race with a rebuild that finished just before we got the lock
+    if _is_fresh(_CACHE):
+        return True
+    # Another worker may already have refreshed
+    if _adopt_shared_snapshot():
+        return True
+
+    with _shared_refresh_lock(wait) as got:
+        if not got:
+            _bump("coalesced_stale")
+            return False
+        if _adopt_shared_snapshot():
+            return True
+
+        started = datetime.now(EASTERN)
+        cutoff = future_cutoff()
+        try:
+            with metric_timer("tradeapp_refresh_stage_seconds", stage="normalize"):
+                people, flat, schedules = normalize_shifts(cutoff, previous=_CACHE)
+        except Exception as e:
+            _LAST_REFRESH_ERROR = {"at": started, "error": repr(e)}
+            _bump("refresh_failures")
+            app.logger.warning("shift refresh failed; keeping previous snapshot: %r", e)
+            if raise_errors:
+                raise
+            return False
+        with metric_timer("tradeapp_refresh_stage_seconds", stage="index"):
+            install_snapshot({
+                "version": _next_version(),
+                "ts": started,
+                "cutoff": cutoff,
+                "people": people,
+                "flat": flat,
+                "schedules": schedules,
+            })
+        _LAST_REFRESH_ERROR = None
+        _bump("refreshes")
+        with metric_timer("tradeapp_refresh_stage_seconds", stage="persist"):
+            saved = save_snapshot_file(_CACHE)
+        if saved:
+            _remember_shared_file()
+        return True
+
+
+def install_snapshot(snap):
+    """
+    Build the per-snapshot lookup indexes and make `snap` the current one.
+    People whose schedule is the very list the current snapshot holds (see
+    normalize_shifts(previous=...)) keep their ids and PersonIndex. When the
+    shifts are exactly the current ones, `snap` takes over the current
+    version and derived caches, so only its ts (and cutoff) are new.
+    """
     global _CACHE
-    now = datetime.now(EASTERN)
-    if _CACHE is not None:
-        ts = _CACHE.get("ts")
-        if ts and (now - ts).total_seconds() < _CACHE_TTL_SECONDS:
-            return _CACHE["people"], _CACHE["flat"], _CACHE["schedules"]
-    people, flat, schedules = normalize_shifts()
-    _CACHE = {"ts": now, "people": people, "flat": flat, "schedules": schedules}
-    return people, flat, schedules
+    prev = _CACHE
+    schedules = snap["schedules"]
+    kept = set()
+    if prev is not None:
+        kept = {p for p, sched in schedules.items() if prev["schedules"].get(p) is sched}
+
+    if kept:
+        by_id = dict(prev["by_id"])
+        for p, ids in prev["by_person"].items():
+            if p not in kept:
+                for sid in ids:
+                    by_id.pop(sid, None)
+        rebuilt = {p: sched for p, sched in schedules.items() if p not in kept}
+        for sched in rebuilt.values():
+            for s in sched:
+                by_id.setdefault(s.id, s)
+        fresh_index = build_schedule_index(rebuilt)
+        snap["by_id"] = by_id
+        snap["by_person"] = {p: prev["by_person"][p] if p in kept else [s.id for s in sched]
+                             for p, sched in schedules.items()}
+        snap["sched_index"] = {p: prev["sched_index"][p] if p in kept else fresh_index[p] for p in schedules}
+    else:
+        by_id = {}
+        for s in snap["flat"]:
+            by_id.setdefault(s.id, s)
+        snap["by_id"] = by_id
+        snap["by_person"] = {p: [s.id for s in sched] for p, sched in schedules.items()}
+        snap["sched_index"] = build_schedule_index(schedules)
+    metric_inc("tradeapp_refresh_people_total", len(kept), how="reused")
+    metric_inc("tradeapp_refresh_people_total", len(schedules) - len(kept), how="rebuilt")
+
+    if prev is not None and snap["people"] == prev["people"] and snap["flat"] == prev["flat"]:
+        # Nothing changed: keep the version, so ETags, the trade-options
+        # cache, the trade matrix and stream clients all stay put
+        snap["version"] = prev["version"]
+        for k in _DERIVED_KEYS:
+            if k in prev:
+                snap[k] = prev[k]
+        metric_inc("tradeapp_refresh_total", result="unchanged")
+        _CACHE = snap
+        return
+
+    metric_inc("tradeapp_refresh_total", result="changed")
+    record_changes(prev, snap, kept)
+    _CACHE = snap
+    invalidate_options_cache()
+    with _SNAPSHOT_CHANGED:
+        _SNAPSHOT_CHANGED.notify_all()
+
+
+# Lazily built per-snapshot data that depends only on the shifts' values
+_DERIVED_KEYS = ("shifts_payload", "by_start", "by_start_keys", "columns")
+
+
+def record_changes(old, new, kept=()):
+    """
+    Append the old -> new shift diff (by id) to the change log. People in
+    `kept` share their schedule between the two snapshots and are skipped.
+    """
+    if old is None:
+        return
+    if new["version"] <= old["version"]:
+        _CHANGE_LOG.clear()  # history no longer leads to `new`; everyone resyncs
+        return
+    old_ids, new_ids = old["by_id"], new["by_id"]
+    if kept:
+        old_scan = (sid for p, ids in old["by_person"].items() if p not in kept for sid in ids)
+        new_scan = (sid for p, ids in new["by_person"].items() if p not in kept for sid in ids)
+        removed = {sid: old_ids[sid] for sid in old_scan if sid not in new_ids}
+        added = {sid: new_ids[sid] for sid in new_scan if sid not in old_ids}
+    else:
+        removed = {sid: s for sid, s in old_ids.items() if sid not in new_ids}
+        added = {sid: s for sid, s in new_ids.items() if sid not in old_ids}
+    _CHANGE_LOG.append({
+        "from": old["version"],
+        "to": new["version"],
+        "removed": removed,
+        "added": added,
+    })
+
+
+def _is_fresh(snap):
+    age = snapshot_age_seconds(snap) if snap is not None else None
+    return age is not None and age < _CACHE_TTL_SECONDS - _REFRESH_AHEAD_SECONDS
+
+
+def _next_version():
+    """Millisecond build stamp, strictly increasing within this process."""
+    now_ms = int(_time.time() * 1000)
+    if _CACHE is not None and now_ms <= _CACHE["version"]:
+        return _CACHE["version"] + 1
+    return now_ms
+
+
+# -------------------------------
+# On-disk snapshot (fast restarts)
+# -------------------------------
+def save_snapshot_file(snap, path=None):
+    """
+    Write `snap` plus per-feed validators atomically (temp file + rename).
+    Shifts are stored per feed as [title, start, end] rows in epoch minutes;
+    ids, eligibility (under the current rules) and schedules are rebuilt on
+    load. Must run right after the normalize_shifts() that built `snap`.
+    Errors are logged, not raised.
+    """
+    path = path or _SNAPSHOT_PATH
+    if not path:
+        return False
+    cutoff = to_minutes(snap["cutoff"])
+    feeds = []
+    for cal in calendars:
+        state = _FEED_STATE.get(_feed_key(cal), {})
+        rows = [
+            [s.title, s.start, s.end]
+            for s in state.get("shifts", []) if s.start >= cutoff
+        ]
+        feeds.append({
+            "name": cal["name"],
+            "url": cal["url"],
+            "etag": state.get("etag"),
+            "last_modified": state.get("last_modified"),
+            "hash": state.get("hash"),
+            "shifts": rows,
+        })
+    doc = {
+        "format": _SNAPSHOT_FORMAT,
+        "version": snap["version"],
+        "ts": snap["ts"].timestamp(),
+        "cutoff": int(snap["cutoff"].timestamp()),
+        "feeds": feeds,
+    }
+    payload = gzip.compress(json.dumps(doc, separators=(",", ":")).encode("utf-8"), compresslevel=5)
+    tmp = None
+    try:
+        fd, tmp = tempfile.mkstemp(prefix=".shift_snapshot.", dir=os.path.dirname(os.path.abspath(path)))
+        with os.fdopen(fd, "wb") as f:
+            f.write(payload)
+        os.replace(tmp, path)
+        return True
+    except OSError as e:
+        app.logger.warning("could not write snapshot file %s: %r", path, e)
+        if tmp and os.path.exists(tmp):
+            os.unlink(tmp)
+        return False
+
+
+def load_snapshot_file(path=None):
+    """
+    Read a snapshot written by save_snapshot_file(). Returns a snapshot dict
+    whose "feeds" entry holds the per-feed validators to restore into
+    _FEED_STATE, or None if the file is missing, too old or unreadable.
+    """
+    path = path or _SNAPSHOT_PATH
+    if not path or not os.path.exists(path):
+        return None
+    try:
+        with gzip.open(path, "rb") as gz:
+            doc = json.loads(gz.read().decode("utf-8"))
+    except (OSError, ValueError) as e:
+        app.logger.warning("ignoring unreadable snapshot file %s: %r", path, e)
+        return None
+    if doc.get("format") != _SNAPSHOT_FORMAT:
+        return None
+    ts = datetime.fromtimestamp(doc["ts"], EASTERN)
+    if (datetime.now(EASTERN) - ts).total_seconds() > _SNAPSHOT_MAX_AGE_SECONDS:
+        return None
+
+    # The day may have rolled over since the file was written
+    cutoff = max(datetime.fromtimestamp(doc["cutoff"], EASTERN), future_cutoff())
+    cutoff_min = to_minutes(cutoff)
+    configured = {_feed_key(cal) for cal in calendars}
+    flat = []
+    feeds = {}
+    for feed in doc["feeds"]:
+        key = (feed["name"], feed["url"])
+        if key not in configured:
+            continue
+        shifts = [
+            make_shift(feed["name"], title, start, end)
+            for title, start, end in feed["shifts"]
+            if start >= cutoff_min
+        ]
+        flat.extend(shifts)
+        feeds[key] = {
+            "etag": feed.get("etag"),
+            "last_modified": feed.get("last_modified"),
+            "hash": feed.get("hash"),
+            "cutoff": cutoff,
+            "shifts": shifts,
+        }
+
+    people = sorted({cal["name"] for cal in calendars})
+    return {
+        "version": doc.get("version") or int(doc["ts"] * 1000),
+        "ts": ts,
+        "cutoff": cutoff,
+        "people": people,
+        "flat": flat,
+        "schedules": group_schedules(flat),
+        "feeds": feeds,
+    }
+
+
+def _refresher_loop():
+    due_age = _CACHE_TTL_SECONDS - _REFRESH_AHEAD_SECONDS
+    retry_at = 0.0
+    delay = 0
+    while True:
+        _REFRESH_WAKE.wait(timeout=delay)
+        _REFRESH_WAKE.clear()
+        # After a failure, requests nudging us must not turn into a retry storm
+        backoff = retry_at - _time.monotonic()
+        if backoff > 0:
+            delay = backoff
+            continue
+        age = snapshot_age_seconds()
+        if age is not None and age < due_age:
+            delay = due_age - age
+            continue
+        if refresh_cache():
+            refresh_trade_matrix()
+            delay = due_age
+        else:
+            delay = _REFRESH_RETRY_SECONDS
+            retry_at = _time.monotonic() + _REFRESH_RETRY_SECONDS
+
+
+def start_background_refresher():
+    """Start the refresh thread once per process (lazily, so it survives gunicorn forks)."""
+    global _REFRESHER
+    if not _BACKGROUND_REFRESH or (_REFRESHER is not None and _REFRESHER.is_alive()):
+        return
+    _REFRESHER = threading.Thread(target=_refresher_loop, name="shift-refresher", daemon=True)
+    _REFRESHER.start()
+
+
+def _snapshot_file_sig():
+    try:
+        st = os.stat(_SNAPSHOT_PATH)
+    except (OSError, TypeError, ValueError):
+        return None
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+
+def _remember_shared_file():
+    global _SHARED_FILE_SIG
+    _SHARED_FILE_SIG = _snapshot_file_sig()
+
+
+def _install_file_snapshot(snap):
+    _FEED_STATE.update(snap.pop("feeds"))
+    install_snapshot(snap)
+
+
+def _adopt_shared_snapshot():
+    """
+    Install the on-disk snapshot when another worker has written a newer,
+    still-fresh version since we last looked. Called with _REFRESH_LOCK held.
+    """
+    global _SHARED_FILE_SIG
+    sig = _snapshot_file_sig()
+    if sig is None or sig == _SHARED_FILE_SIG:
+        return False
+    snap = load_snapshot_file()
+    _SHARED_FILE_SIG = sig
+    if snap is None or not _is_fresh(snap):
+        return False
+    # An unchanged refresh rewrites the same version with a newer ts
+    if _CACHE is not None and (snap["version"], snap["ts"]) <= (_CACHE["version"], _CACHE["ts"]):
+        return False
+    _install_file_snapshot(snap)
+    _bump("shared_loads")
+    return True
+
+
+@contextmanager
+def _shared_refresh_lock(wait, suffix=".lock"):
+    """
+    Cross-process refresh lock (flock on <snapshot><suffix>). Yields False
+    when another worker holds it and `wait` is False; without fcntl or a
+    snapshot path it always yields True.
+    """
+    if fcntl is None or not _SNAPSHOT_PATH:
+        yield True
+        return
+    try:
+        fd = os.open(_SNAPSHOT_PATH + suffix, os.O_RDWR | os.O_CREAT, 0o644)
+    except OSError:
+        yield True
+        return
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | (0 if wait else fcntl.LOCK_NB))
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+    finally:
+        os.close(fd)
+
+
+def _load_persisted_snapshot():
+    with _REFRESH_LOCK:
+        if _CACHE is None:
+            snap = load_snapshot_file()
+            _remember_shared_file()
+            if snap is not None:
+                _install_file_snapshot(snap)
+                app.logger.info("loaded %d shifts from %s", len(snap["flat"]), _SNAPSHOT_PATH)
+
+
+def load_snapshot(observe=True):
+    """
+    Return the current snapshot dict (people, flat, schedules, by_id, ...).
+    Only the very first load fetches inline; after that an expired snapshot
+    is served stale while the background refresher rebuilds it. Internal
+    polling passes observe=False to stay out of the load counter.
+    """
+    cold = _CACHE is None
+    if cold:
+        _load_persisted_snapshot()
+    if _CACHE is None:
+        refresh_cache(raise_errors=True)
+    start_background_refresher()
+
+    stale = snapshot_age_seconds() >= _CACHE_TTL_SECONDS
+    if observe:
+        metric_inc("tradeapp_snapshot_loads_total", result="cold" if cold else "stale" if stale else "fresh")
+    if stale:
+        if _REFRESHER is not None and _REFRESHER.is_alive():
+            _REFRESH_WAKE.set()
+        else:
+            # inline; if someone else is already rebuilding, or it fails, serve stale
+            refresh_cache(wait=False)
+
+    return _CACHE
+
+
+def load_data_cached():
+    """Return (people, flat, schedules) from the current snapshot."""
+    snap = load_snapshot()
+    return snap["people"], snap["flat"], snap["schedules"]
 
 
 # -------------------------------
@@ -159,49 +1266,96 @@ def load_data_cached():
 def intervals_overlap(a_start, a_end, b_start, b_end):
     return (a_start < b_end) and (b_start < a_end)
 
-def is_free_for_interval(person_shifts, interval_start, interval_end, exclude_id=None):
-    for s in person_shifts:
-        if exclude_id and s["id"] == exclude_id:
-            continue
-        if intervals_overlap(s["start"], s["end"], interval_start, interval_end):
+class PersonIndex(NamedTuple):
+    starts: list        # shift starts, ascending
+    max_end: list       # max_end[i] = latest end among shifts[0..i]
+    week_minutes: dict  # week start -> total scheduled minutes that week
+    dups: dict          # id -> count, only for ids that appear more than once
+
+def build_schedule_index(schedules):
+    """person -> PersonIndex over that person's start-sorted schedule. Built once per snapshot."""
+    index = {}
+    for p, sched in schedules.items():
+        starts = [s.start for s in sched]
+        max_end = []
+        week_minutes = defaultdict(int)
+        seen = defaultdict(int)
+        m = None
+        for s in sched:
+            m = s.end if m is None or s.end > m else m
+            max_end.append(m)
+            week_minutes[s.week] += s.end - s.start
+            seen[s.id] += 1
+        dups = {k: n for k, n in seen.items() if n > 1}
+        index[p] = PersonIndex(starts, max_end, dict(week_minutes), dups)
+    return index
+
+def is_free_for_interval(person_shifts, interval_start, interval_end, exclude_id=None, index=None):
+    if index is None:
+        for s in person_shifts:
+            if exclude_id and s.id == exclude_id:
+                continue
+            if intervals_overlap(s.start, s.end, interval_start, interval_end):
+                return False
+        return True
+
+    # Only shifts starting before the interval ends can overlap it. Walk back
+    # from there until the max-end prefix says no earlier shift reaches in.
+    starts, max_end = index.starts, index.max_end
+    i = bisect_left(starts, interval_end) - 1
+    while i >= 0 and max_end[i] > interval_start:
+        s = person_shifts[i]
+        if s.end > interval_start and not (exclude_id and s.id == exclude_id):
             return False
+        i -= 1
     return True
 
-def local_break_ok(sorted_shifts, idx):
+def rest_gap_ok(prev, cur, nxt):
     """
-    Localized rest rule around affected shift only:
+    Rest rule around `cur` given its neighbours (either may be None):
       - gap(prev→cur) >= duration(prev)
       - gap(cur →next) >= duration(cur)
     """
-    cur = sorted_shifts[idx]
-    prev = sorted_shifts[idx - 1] if idx > 0 else None
-    nxt  = sorted_shifts[idx + 1] if idx + 1 < len(sorted_shifts) else None
-
-    if prev:
-        gap_prev = cur["start"] - prev["end"]
-        dur_prev = prev["end"] - prev["start"]
-        if gap_prev < dur_prev:
+    if prev is not None:
+        if cur.start - prev.end < prev.end - prev.start:
             return False
-
-    if nxt:
-        gap_cur = nxt["start"] - cur["end"]
-        dur_cur = cur["end"] - cur["start"]
-        if gap_cur < dur_cur:
+    if nxt is not None:
+        if nxt.start - cur.end < cur.end - cur.start:
             return False
-
     return True
 
+def swap_neighbors(sched, starts, at, skip_id):
+    """
+    Neighbours a shift starting at `at` would get if inserted into the sorted
+    `sched` with the shift `skip_id` taken out, without building that list.
+    Ties on start go before the inserted shift, as a stable sort would.
+    """
+    p = bisect_right(starts, at)
+    i = p - 1
+    while i >= 0 and sched[i].id == skip_id:
+        i -= 1
+    j = p
+    while j < len(sched) and sched[j].id == skip_id:
+        j += 1
+    return (sched[i] if i >= 0 else None), (sched[j] if j < len(sched) else None)
+
 
 # -------------------------------
 # Trade simulation (+ 60h cap rule after swap)
 # -------------------------------
-def simulate_swap_ok(schedules, trader_shift, tradee_shift):
+def simulate_swap_ok(schedules, trader_shift, tradee_shift, sched_index=None):
+    """
+    Check whether A (trader) and B (tradee) may swap these two shifts.
+    The swap is simulated virtually: each person's sorted schedule is read
+    in place with the given-up shift skipped, so nothing is copied or re-sorted.
+    Returns (ok, reason).
+    """
     # Titles must be eligible (allow-list) and not excluded
-    if not (trader_shift["eligible"] and tradee_shift["eligible"]):
+    if not (trader_shift.eligible and tradee_shift.eligible):
         return False, "ineligible-title"
 
-    A = trader_shift["person"]
-    B = tradee_shift["person"]
+    A = trader_shift.person
+    B = tradee_shift.person
     if A == B:
         return False, "same-person"
 
@@ -211,80 +1365,971 @@ def simulate_swap_ok(schedules, trader_shift, tradee_shift):
     A_sched = schedules[A]
     B_sched = schedules[B]
 
+    if sched_index is None:
+        sched_index = build_schedule_index({A: A_sched, B: B_sched})
+    A_index = sched_index[A]
+    B_index = sched_index[B]
+
     # Availability (ignore the shift they are giving up)
-    if not is_free_for_interval(B_sched, sA["start"], sA["end"], exclude_id=sB["id"]):
+    if not is_free_for_interval(B_sched, sA.start, sA.end, exclude_id=sB.id, index=B_index):
         return False, "B-not-free-for-A"
-    if not is_free_for_interval(A_sched, sB["start"], sB["end"], exclude_id=sA["id"]):
+    if not is_free_for_interval(A_sched, sB.start, sB.end, exclude_id=sA.id, index=A_index):
         return False, "A-not-free-for-B"
 
-    # Simulate swap (change owners)
-    def clone_for(new_person, s):
-        return {
-            **s,
-            "person": new_person,
-            "id": f'{new_person}|{iso(s["start"])}|{iso(s["end"])}|{s["title"]}',
-        }
-
-    sB_for_A = clone_for(A, sB)
-    sA_for_B = clone_for(B, sA)
-
-    A_prime = [x for x in A_sched if x["id"] != sA["id"]] + [sB_for_A]
-    B_prime = [x for x in B_sched if x["id"] != sB["id"]] + [sA_for_B]
-    A_prime.sort(key=lambda x: x["start"])
-    B_prime.sort(key=lambda x: x["start"])
-
-    # Localized rest checks
-    a_idx = A_prime.index(sB_for_A)
-    b_idx = B_prime.index(sA_for_B)
-
-    if not local_break_ok(A_prime, a_idx):
+    # Localized rest checks: A takes sB in place of sA, B takes sA in place of sB
+    a_prev, a_next = swap_neighbors(A_sched, A_index.starts, sB.start, sA.id)
+    if not rest_gap_ok(a_prev, sB, a_next):
         return False, "A-break-rule"
-    if not local_break_ok(B_prime, b_idx):
+    b_prev, b_next = swap_neighbors(B_sched, B_index.starts, sA.start, sB.id)
+    if not rest_gap_ok(b_prev, sA, b_next):
         return False, "B-break-rule"
 
-    # Weekly cap (<= 60h) check for both around the new shift's week
-    def week_caps_ok(prime_sched, new_shift):
-        start = new_shift["start"]
-        weekday = start.weekday()  # Monday=0
-        week_start = (start - timedelta(days=weekday)).replace(hour=0, minute=0, second=0, microsecond=0)
-        week_end = week_start + timedelta(days=7)
-        total = 0.0
-        for s in prime_sched:
-            if week_start <= s["start"] < week_end:
-                total += (s["end"] - s["start"]).total_seconds() / 3600.0
-        return total <= 60.0
-
-    if not week_caps_ok(A_prime, sB_for_A):
+    # Weekly cap (<= 60h) for both, in the received shift's week:
+    # precomputed bucket - given-up shift (if same week) + received shift
+    def week_caps_ok(idx, given_up, received):
+        total = idx.week_minutes.get(received.week, 0) + (received.end - received.start)
+        if given_up.week == received.week:
+            total -= (given_up.end - given_up.start) * idx.dups.get(given_up.id, 1)
+        return total <= 60 * 60  # minutes
+
+    if not week_caps_ok(A_index, sA, sB):
         return False, "A-weekly-cap"
-    if not week_caps_ok(B_prime, sA_for_B):
+    if not week_caps_ok(B_index, sB, sA):
         return False, "B-weekly-cap"
 
     return True, "ok"
 
 
+# -------------------------------
+# Batched trade engine (NumPy)
+# -------------------------------
+SWAP_REASONS = [
+    "ok", "ineligible-title", "same-person", "B-not-free-for-A", "A-not-free-for-B",
+    "A-break-rule", "B-break-rule", "A-weekly-cap", "B-weekly-cap",
+]
+SWAP_REASON_CODES = {r: i for i, r in enumerate(SWAP_REASONS)}
+_KEY_SHIFT = 1 << 32  # person code * _KEY_SHIFT + start minute sorts like (person, start)
+
+def build_columns(snap):
+    """
+    Columnar copy of the snapshot for the batched engine: every person's
+    sorted schedule laid end to end (so each person is a contiguous block),
+    with start/end/duration/week as int64 and a person code per row.
+    """
+    schedules = snap["schedules"]
+    people = sorted(schedules)
+    rows = [s for p in people for s in schedules[p]]
+    n = len(rows)
+    sizes = np.array([len(schedules[p]) for p in people], dtype=np.int64)
+    hi = np.cumsum(sizes)
+    lo = hi - sizes
+    pcode = np.repeat(np.arange(len(people), dtype=np.int64), sizes)
+    start = np.fromiter((s.start for s in rows), dtype=np.int64, count=n)
+    end = np.fromiter((s.end for s in rows), dtype=np.int64, count=n)
+    sched_index = snap["sched_index"]
+    flat_pos = {id(s): i for i, s in enumerate(snap["flat"])}
+    return {
+        "people": people,
+        "code": {p: i for i, p in enumerate(people)},
+        "rows": rows,
+        "lo": lo,
+        "hi": hi,
+        "pcode": pcode,
+        "start": start,
+        "end": end,
+        "dur": end - start,
+        "week": np.fromiter((s.week for s in rows), dtype=np.int64, count=n),
+        "eligible": np.fromiter((s.eligible for s in rows), dtype=bool, count=n),
+        "key": pcode * _KEY_SHIFT + start,
+        # copies of each row's id within its person's schedule (1 unless the feed repeats an event)
+        "idcount": np.fromiter((sched_index[s.person].dups.get(s.id, 1) for s in rows), dtype=np.int64, count=n),
+        "flat_pos": np.fromiter((flat_pos[id(s)] for s in rows), dtype=np.int64, count=n),
+    }
+
+def snapshot_columns(snap):
+    cols = snap.get("columns")
+    if cols is None:
+        cols = snap.setdefault("columns", build_columns(snap))
+    return cols
+
+def vector_swap_reasons(snap, trader_shift):
+    """
+    simulate_swap_ok(trader_shift, x) for every shift x at once. Returns
+    (columns, reason codes into SWAP_REASONS in column order). Each rule is
+    evaluated as a whole-array mask, and the first failing rule wins, in the
+    same order as the scalar simulator.
+    """
+    c = snapshot_columns(snap)
+    sA = trader_shift
+    start, end, dur, week, pcode = c["start"], c["end"], c["dur"], c["week"], c["pcode"]
+    idcount = c["idcount"]
+    n = len(start)
+    n_people = len(c["people"])
+    a = c["code"][sA.person]
+    a_dur = sA.end - sA.start
+
+    inelig = ~(c["eligible"] & bool(sA.eligible))
+    same = pcode == a
+
+    # B must be free for sA, ignoring sB (and any copies of it)
+    ov = (start < sA.end) & (end > sA.start)
+    busy = np.bincount(pcode, weights=ov, minlength=n_people)
+    b_busy = busy[pcode] - ov * idcount > 0
+
+    # A's schedule without the shift being given up
+    a_rows = np.arange(c["lo"][a], c["hi"][a])
+    a_rows = a_rows[[c["rows"][k].id != sA.id for k in a_rows]] if len(a_rows) else a_rows
+    a_copies = (c["hi"][a] - c["lo"][a]) - len(a_rows)
+    S, E = start[a_rows], end[a_rows]
+    m = len(a_rows)
+    if m:
+        # A must be free for sB: some earlier-starting shift reaching past sB.start?
+        M = np.maximum.accumulate(E)
+        i = np.searchsorted(S, end, "left")
+        a_busy = (i > 0) & (M[np.maximum(i - 1, 0)] > start)
+        # A's rest rule with sB inserted
+        p = np.searchsorted(S, start, "right")
+        pv = np.maximum(p - 1, 0)
+        nx = np.minimum(p, m - 1)
+        prev_ok = (p == 0) | (start - E[pv] >= E[pv] - S[pv])
+        next_ok = (p == m) | (S[nx] - end >= dur)
+        a_break = ~(prev_ok & next_ok)
+    else:
+        a_busy = a_break = np.zeros(n, dtype=bool)
+
+    # B's rest rule with sA inserted, stepping over sB itself
+    rank = np.arange(n)
+    pos = np.searchsorted(c["key"], pcode * _KEY_SHIFT + sA.start, "right")
+    pv = pos - 1
+    pv = np.where(pv == rank, pv - 1, pv)
+    nx = np.where(pos == rank, pos + 1, pos)
+    has_prev = pv >= c["lo"][pcode]
+    has_next = nx < c["hi"][pcode]
+    pv = np.clip(pv, 0, max(n - 1, 0))
+    nx = np.clip(nx, 0, max(n - 1, 0))
+    prev_ok = ~has_prev | (sA.start - end[pv] >= dur[pv])
+    next_ok = ~has_next | (start[nx] - sA.end >= a_dur)
+    b_break = ~(prev_ok & next_ok)
+
+    # Weekly caps: bucket - given-up (same week) + received
+    a_weeks = snap["sched_index"][sA.person].week_minutes
+    wk_keys = np.array(sorted(a_weeks), dtype=np.int64)
+    wk_tot = np.array([a_weeks[k] for k in wk_keys.tolist()], dtype=np.int64)
+    if len(wk_keys):
+        wi = np.minimum(np.searchsorted(wk_keys, week), len(wk_keys) - 1)
+        a_bucket = np.where(wk_keys[wi] == week, wk_tot[wi], 0)
+    else:
+        a_bucket = np.zeros(n, dtype=np.int64)
+    a_total = a_bucket + dur - (week == sA.week) * (a_dur * a_copies)
+    b_bucket = np.bincount(pcode, weights=dur * (week == sA.week), minlength=n_people)
+    b_total = b_bucket[pcode] - (week == sA.week) * dur * idcount + a_dur
+    a_cap = a_total > 60 * 60
+    b_cap = b_total > 60 * 60
+
+    reasons = np.select(
+        [inelig, same, b_busy, a_busy, a_break, b_break, a_cap, b_cap],
+        [1, 2, 3, 4, 5, 6, 7, 8],
+        default=0,
+    )
+    # Stepping over a repeated sB in B's rest rule is not expressible above;
+    # ask the scalar path for those (rare) rows
+    redo = (idcount > 1) & ((reasons == 0) | (reasons >= 5))
+    for k in np.nonzero(redo)[0]:
+        _, reason = simulate_swap_ok(snap["schedules"], sA, c["rows"][k], snap["sched_index"])
+        reasons[k] = SWAP_REASON_CODES[reason]
+    return c, reasons
+
+def scalar_trade_candidates(snap, trader_shift):
+    """Shifts `trader_shift` may be swapped for, in flat order, as (shift, reason)."""
+    out = []
+    for sB in snap["flat"]:
+        if sB.person == trader_shift.person:
+            continue
+        ok, reason = simulate_swap_ok(snap["schedules"], trader_shift, sB, snap["sched_index"])
+        if ok:
+            out.append((sB, reason))
+    return out
+
+def vector_trade_candidates(snap, trader_shift):
+    """Same result as scalar_trade_candidates(), via vector_swap_reasons()."""
+    c, reasons = vector_swap_reasons(snap, trader_shift)
+    hits = np.nonzero((reasons == 0) & (c["pcode"] != c["code"][trader_shift.person]))[0]
+    hits = hits[np.argsort(c["flat_pos"][hits], kind="stable")]
+    rows = c["rows"]
+    return [(rows[k], "ok") for k in hits.tolist()]
+
+def count_trade_evaluations(snap, engine, trader_shift):
+    """The batch evaluates every row; the scalar walk skips the trader's own shifts."""
+    n = len(snap["flat"])
+    if engine == "scalar":
+        n -= len(snap["schedules"].get(trader_shift.person, ()))
+    metric_inc("tradeapp_trade_evaluations_total", n, engine=engine)
+    metric_observe("tradeapp_trade_evaluations_per_computation", n, buckets=_COUNT_BUCKETS, engine=engine)
+
+def trade_candidates(snap, trader_shift):
+    use_vector = np is not None and _TRADE_ENGINE != "scalar"
+    count_trade_evaluations(snap, "vector" if use_vector else "scalar", trader_shift)
+    if not use_vector:
+        return scalar_trade_candidates(snap, trader_shift)
+    result = vector_trade_candidates(snap, trader_shift)
+    if _TRADE_ENGINE_PARITY:
+        expected = scalar_trade_candidates(snap, trader_shift)
+        if result != expected:
+            app.logger.error("trade engine parity mismatch for %s: vector=%d scalar=%d candidates",
+                             trader_shift.id, len(result), len(expected))
+            return expected
+    return result
+
+def iter_trade_candidates(snap, trader_shift):
+    """
+    trade_candidates() in (start, person) order, yielded as they are found:
+    the scalar engine walks the by-start index and checks one tradee at a
+    time; the vector engine evaluates the batch first and then yields it.
+    """
+    if np is not None and _TRADE_ENGINE != "scalar":
+        yield from sorted(trade_candidates(snap, trader_shift), key=lambda c: (c[0].start, c[0].person))
+        return
+    count_trade_evaluations(snap, "scalar", trader_shift)
+    ordered, _ = shifts_by_start(snap)
+    for sB in ordered:
+        if sB.person == trader_shift.person:
+            continue
+        ok, reason = simulate_swap_ok(snap["schedules"], trader_shift, sB, snap["sched_index"])
+        if ok:
+            yield sB, reason
+
+def check_engine_parity(snap=None):
+    """
+    Compare vector_swap_reasons() against simulate_swap_ok() for every
+    (trader, tradee) pair in the snapshot. Returns a list of mismatches.
+    """
+    snap = snap or load_snapshot()
+    mismatches = []
+    for sA in snap["flat"]:
+        c, reasons = vector_swap_reasons(snap, sA)
+        for k, sB in enumerate(c["rows"]):
+            _, expected = simulate_swap_ok(snap["schedules"], sA, sB, snap["sched_index"])
+            got = SWAP_REASONS[reasons[k]]
+            if got != expected:
+                mismatches.append((sA.id, sB.id, got, expected))
+    return mismatches
+
+@app.cli.command("check-parity")
+def check_parity_command():
+    """Prove the batched engine agrees with simulate_swap_ok on the live snapshot."""
+    if np is None:
+        raise SystemExit("numpy is not installed; only the scalar engine is available")
+    mismatches = check_engine_parity()
+    for m in mismatches[:20]:
+        click.echo("MISMATCH trader=%s tradee=%s vector=%s scalar=%s" % m)
+    click.echo("%d mismatches" % len(mismatches))
+    if mismatches:
+        raise SystemExit(1)
+
+
+# -------------------------------
+# All-pairs trade matrix (process pool)
+# -------------------------------
+def matrix_rows(snap):
+    """Shifts in the matrix's row order: each person's sorted schedule, people sorted (= column order)."""
+    schedules = snap["schedules"]
+    return [s for p in sorted(schedules) for s in schedules[p]]
+
+def _matrix_shard(trader_rows):
+    """Pool worker: for each trader row, the rows it can swap with plus per-reason counts."""
+    snap = _MATRIX_SNAP
+    rows = matrix_rows(snap) if np is None else snapshot_columns(snap)["rows"]
+    out = []
+    for k in trader_rows:
+        sA = rows[k]
+        if np is not None:
+            _, codes = vector_swap_reasons(snap, sA)
+            counts = np.bincount(codes, minlength=len(SWAP_REASONS)).tolist()
+            ok = array("I", np.nonzero(codes == 0)[0].tolist())
+        else:
+            counts = [0] * len(SWAP_REASONS)
+            ok = array("I")
+            for j, sB in enumerate(rows):
+                _, reason = simulate_swap_ok(snap["schedules"], sA, sB, snap["sched_index"])
+                code = SWAP_REASON_CODES[reason]
+                counts[code] += 1
+                if code == 0:
+                    ok.append(j)
+        out.append((k, ok, counts))
+    return out
+
+def build_trade_matrix(snap, workers=None):
+    """
+    Evaluate every (trader, tradee) pair in `snap`. Only eligible shifts are
+    traders (everything else is "ineligible-title" by definition). Traders are
+    sharded round-robin across a fork()ed process pool that inherits the
+    snapshot, so nothing big is pickled. Where fork is unavailable the shards
+    run in-process.
+
+    Returns a sparse result: swappable pairs in CSR form (indptr/indices over
+    row numbers) plus, per trader, a count of pairs for each SWAP_REASONS code.
+    """
+    global _MATRIX_SNAP
+    t0 = _time.perf_counter()
+    rows = matrix_rows(snap)
+    traders = [k for k, s in enumerate(rows) if s.eligible]
+    workers = max(1, min(workers or _MATRIX_WORKERS, len(traders) or 1))
+    shards = [traders[i::workers * 4] for i in range(workers * 4)]
+    shards = [sh for sh in shards if sh]
+
+    _MATRIX_SNAP = snap
+    try:
+        if np is not None:
+            snapshot_columns(snap)  # build once here so children inherit it
+        try:
+            ctx = multiprocessing.get_context("fork") if workers > 1 else None
+        except ValueError:
+            ctx = None
+        if ctx is not None:
+            with ctx.Pool(workers) as pool:
+                parts = pool.map(_matrix_shard, shards)
+        else:
+            parts = [_matrix_shard(sh) for sh in shards]
+    finally:
+        _MATRIX_SNAP = None
+
+    by_trader = {k: (ok, counts) for part in parts for k, ok, counts in part}
+    indptr = array("Q", [0])
+    indices = array("I")
+    reason_counts = []
+    for k in traders:
+        ok, counts = by_trader[k]
+        indices.extend(ok)
+        indptr.append(len(indices))
+        reason_counts.append(counts)
+
+    return {
+        "version": snap["version"],
+        "ids": [s.id for s in rows],
+        "traders": array("I", traders),
+        "indptr": indptr,
+        "indices": indices,
+        "reason_counts": reason_counts,
+        "workers": workers if ctx is not None else 1,
+        "seconds": round(_time.perf_counter() - t0, 3),
+    }
+
+def get_trade_matrix(snap):
+    """
+    The last finished matrix (None before the first build completes; it may
+    be for an older version than `snap`). Starts a background build when it
+    is not for `snap` and none is running; never builds on the caller's thread.
+    """
+    global _MATRIX_BUILDING
+    with _MATRIX_LOCK:
+        m = _MATRIX
+        if (m is None or m["version"] != snap["version"]) and not _MATRIX_BUILDING:
+            _MATRIX_BUILDING = True
+            threading.Thread(target=_matrix_builder, name="trade-matrix", daemon=True).start()
+    return m
+
+def _matrix_builder():
+    """
+    Bring the matrix up to the current snapshot (single-flight): adopt the
+    shared matrix file when another worker already wrote this version, wait
+    for it while another worker is building, otherwise build and share it.
+    """
+    global _MATRIX, _MATRIX_BUILDING
+    try:
+        while True:
+            with _MATRIX_LOCK:
+                snap = _CACHE
+                if _MATRIX is not None and _MATRIX["version"] == snap["version"]:
+                    _MATRIX_BUILDING = False
+                    return
+            m = load_matrix_file(snap["version"])
+            if m is None:
+                with _shared_refresh_lock(False, suffix=".matrix.lock") as got:
+                    if got:
+                        m = load_matrix_file(snap["version"])
+                        if m is None:
+                            with metric_timer("tradeapp_trade_matrix_build_seconds"):
+                                m = build_trade_matrix(snap)
+                            save_matrix_file(m)
+                if m is None:
+                    _time.sleep(_MATRIX_ADOPT_POLL_SECONDS)
+                    continue
+            else:
+                metric_inc("tradeapp_trade_matrix_adopted_total")
+            m["row_of"] = {}
+            for k, sid in enumerate(m["ids"]):
+                m["row_of"].setdefault(sid, k)
+            m["trader_pos"] = {k: i for i, k in enumerate(m["traders"])}
+            with _MATRIX_LOCK:
+                _MATRIX = m
+    except Exception:
+        app.logger.exception("trade matrix build failed")
+        with _MATRIX_LOCK:
+            _MATRIX_BUILDING = False
+
+def _matrix_path():
+    return _SNAPSHOT_PATH + ".matrix" if _SNAPSHOT_PATH else None
+
+def save_matrix_file(m):
+    """Write a built matrix next to the snapshot file for other workers (atomic; errors logged)."""
+    path = _matrix_path()
+    if not path:
+        return False
+    doc = {k: m[k] for k in ("version", "ids", "reason_counts", "workers", "seconds")}
+    doc["format"] = _MATRIX_FORMAT
+    for k in ("traders", "indptr", "indices"):
+        doc[k] = [m[k].typecode, base64.b64encode(m[k].tobytes()).decode("ascii")]
+    payload = gzip.compress(json.dumps(doc, separators=(",", ":")).encode("utf-8"), compresslevel=1)
+    tmp = None
+    try:
+        fd, tmp = tempfile.mkstemp(prefix=".shift_matrix.", dir=os.path.dirname(os.path.abspath(path)))
+        with os.fdopen(fd, "wb") as f:
+            f.write(payload)
+        os.replace(tmp, path)
+        return True
+    except OSError as e:
+        app.logger.warning("could not write matrix file %s: %r", path, e)
+        if tmp and os.path.exists(tmp):
+            os.unlink(tmp)
+        return False
+
+def load_matrix_file(version):
+    """The shared matrix when it was built for snapshot `version`, else None."""
+    path = _matrix_path()
+    if not path or not os.path.exists(path):
+        return None
+    try:
+        with gzip.open(path, "rb") as gz:
+            doc = json.loads(gz.read().decode("utf-8"))
+    except (OSError, ValueError) as e:
+        app.logger.warning("ignoring unreadable matrix file %s: %r", path, e)
+        return None
+    if doc.get("format") != _MATRIX_FORMAT or doc.get("version") != version:
+        return None
+    for k in ("traders", "indptr", "indices"):
+        typecode, data = doc[k]
+        doc[k] = array(typecode)
+        doc[k].frombytes(base64.b64decode(data))
+    del doc["format"]
+    return doc
+
+def refresh_trade_matrix():
+    """Keep an already-used matrix current after a refresh; dashboards that never asked cost nothing."""
+    if _MATRIX is not None and _CACHE is not None:
+        get_trade_matrix(_CACHE)
+
+
 # -------------------------------
 # API: shifts (future only)
 # -------------------------------
+def shifts_payload(snap):
+    """
+    /shifts.json body for `snap`, serialized once per snapshot: raw and
+    gzip-compressed bytes plus a strong ETag derived from the content.
+    """
+    payload = snap.get("shifts_payload")
+    if payload is None:
+        with metric_timer("tradeapp_encode_seconds", what="shifts_json"):
+            out = [shift_json(s) for s in snap["flat"]]
+            body = app.json.dumps({"people": snap["people"], "shifts": out}).encode("utf-8")
+        with metric_timer("tradeapp_encode_seconds", what="shifts_gzip"):
+            compressed = gzip.compress(body, compresslevel=6)
+        payload = snap.setdefault("shifts_payload", {
+            "body": body,
+            "gzip": compressed,
+            "etag": hashlib.sha256(body).hexdigest()[:32],
+        })
+    return payload
+
+
+_SHIFTS_PAGE_DEFAULT = 500
+_SHIFTS_PAGE_MAX = 5000
+_SHIFTS_QUERY_PARAMS = ("person", "start", "end", "eligible", "cursor", "limit")
+
+
+def shifts_by_start(snap):
+    """All shifts ordered by (start, person), built once per snapshot."""
+    ordered = snap.get("by_start")
+    if ordered is None:
+        ordered = sorted(snap["flat"], key=lambda s: (s.start, s.person))
+        snap.setdefault("by_start_keys", [s.start for s in ordered])
+        ordered = snap.setdefault("by_start", ordered)
+    return ordered, snap["by_start_keys"]
+
+
+def parse_query_time(value):
+    """ISO date or datetime query value -> epoch minutes (naive values are Eastern)."""
+    dt = datetime.fromisoformat(value)
+    if dt.tzinfo is None:
+        dt = EASTERN.localize(dt)
+    return to_minutes(dt)
+
+
+def encode_cursor(ordered, starts, i):
+    """
+    Opaque cursor for ordered[i]: its start, id and which copy of that id it
+    is among shifts with the same start (feeds can repeat an event).
+    """
+    s = ordered[i]
+    nth = sum(1 for k in range(bisect_left(starts, s.start), i) if ordered[k].id == s.id)
+    raw = json.dumps([s.start, s.id, nth], separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii")
+
+
+def decode_cursor(cursor):
+    start, sid, nth = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    return int(start), str(sid), int(nth)
+
+
+def resume_position(ordered, starts, cursor):
+    """Index just past the cursor's shift, found by start then id among ties."""
+    start, sid, nth = cursor
+    j = bisect_left(starts, start)
+    while j < len(ordered) and ordered[j].start == start:
+        if ordered[j].id == sid:
+            if nth == 0:
+                return j + 1
+            nth -= 1
+        j += 1
+    return j  # shift gone since the cursor was issued: continue after its start
+
+
+def filtered_shifts(snap, person=None, start=None, end=None, eligible_only=False, cursor=None, limit=None):
+    """
+    One page of shifts in start order, read from the per-person sorted
+    schedule (or the global by-start index when no person is given).
+    Returns (shifts, cursor for the next page or None).
+    """
+    if person is not None:
+        ordered = snap["schedules"].get(person, [])
+        starts = snap["sched_index"][person].starts if ordered else []
+    else:
+        ordered, starts = shifts_by_start(snap)
+
+    i = bisect_left(starts, start) if start is not None else 0
+    if cursor is not None:
+        i = max(i, resume_position(ordered, starts, cursor))
+    stop = bisect_left(starts, end) if end is not None else len(ordered)
+
+    page = []
+    last = None
+    while i < stop:
+        s = ordered[i]
+        if not (eligible_only and not s.eligible):
+            if len(page) == limit:
+                return page, encode_cursor(ordered, starts, last)
+            page.append(s)
+            last = i
+        i += 1
+    return page, None
+
+
+def shifts_query_response(snap):
+    args = request.args
+    try:
+        start = parse_query_time(args["start"]) if args.get("start") else None
+        end = parse_query_time(args["end"]) if args.get("end") else None
+        cursor = decode_cursor(args["cursor"]) if args.get("cursor") else None
+        limit = int(args.get("limit") or _SHIFTS_PAGE_DEFAULT)
+    except (ValueError, TypeError):
+        return jsonify({"error": "bad start/end/cursor/limit"}), 400
+    limit = max(1, min(limit, _SHIFTS_PAGE_MAX))
+    eligible_only = args.get("eligible", "").lower() in ("1", "true", "yes")
+
+    page, next_cursor = filtered_shifts(snap, args.get("person") or None, start, end, eligible_only, cursor, limit)
+    resp = jsonify({
+        "people": snap["people"],
+        "shifts": [shift_json(s) for s in page],
+        "next_cursor": next_cursor,
+    })
+    resp.headers["X-Snapshot-Version"] = str(snap["version"])
+    return resp
+
+
 @app.route("/shifts.json")
 def shifts_json():
-    people, flat, _ = load_data_cached()
-    out = []
-    for s in flat:
-        out.append({
-            "id": s["id"],
-            "person": s["person"],
-            "title": s["title"],
-            "start": iso(s["start"]),
-            "end": iso(s["end"]),
-            "eligible": s["eligible"],
-        })
-    return jsonify({"people": people, "shifts": out})
+    """
+    All future shifts, or with any of ?person= &start= &end= (ISO, start
+    time window) &eligible=1 &limit= &cursor= a filtered page of them plus
+    next_cursor.
+    """
+    snap = load_snapshot()
+    if any(k in request.args for k in _SHIFTS_QUERY_PARAMS):
+        return shifts_query_response(snap)
+
+    payload = shifts_payload(snap)
+    gz = request.accept_encodings["gzip"] > 0
+    # Each representation gets its own strong validator
+    etag = payload["etag"] + ("-gz" if gz else "")
+
+    if request.if_none_match.contains_weak(etag):
+        resp = app.response_class(status=304)
+    else:
+        resp = app.response_class(payload["gzip"] if gz else payload["body"], mimetype="application/json")
+        if gz:
+            resp.headers["Content-Encoding"] = "gzip"
+    resp.set_etag(etag)
+    resp.headers["Vary"] = "Accept-Encoding"
+    resp.headers["Cache-Control"] = "no-cache"  # browsers may keep it but must revalidate
+    resp.headers["X-Snapshot-Age"] = str(int(snapshot_age_seconds() or 0))
+    resp.headers["X-Snapshot-Version"] = str(snap["version"])
+    return resp
+
+
+def changes_since(version, current):
+    """
+    Net (removed, added) shifts between snapshot `version` and `current`,
+    composed from the change log, or None when that history is gone.
+    """
+    log = list(_CHANGE_LOG)
+    i = next((k for k, e in enumerate(log) if e["from"] == version), None)
+    if i is None:
+        return None
+    removed, added = {}, {}
+    at = version
+    for e in log[i:]:
+        if e["from"] != at:
+            return None
+        for sid, s in e["removed"].items():
+            if added.pop(sid, None) is None:
+                removed[sid] = s
+        for sid, s in e["added"].items():
+            if removed.pop(sid, None) is None:
+                added[sid] = s
+        at = e["to"]
+        if at == current:
+            return removed, added
+    return None
+
+
+def delta_json(removed, added):
+    """
+    Delta body: a removed and an added shift for the same person and start
+    (title or end changed) are reported together as one modification.
+    """
+    by_slot = defaultdict(list)
+    for s in removed.values():
+        by_slot[(s.person, s.start)].append(s)
+    modified, plain_added = [], []
+    for s in sorted(added.values(), key=lambda s: (s.start, s.person)):
+        olds = by_slot.get((s.person, s.start))
+        if olds:
+            old = olds.pop()
+            del removed[old.id]
+            modified.append({"old_id": old.id, "shift": shift_json(s)})
+        else:
+            plain_added.append(shift_json(s))
+    return {"added": plain_added, "removed": sorted(removed), "modified": modified}
+
+
+def catch_up_snapshot(version, observe=True):
+    """
+    The current snapshot, after trying to adopt the shared snapshot file when
+    a client already holds a newer `version` (served by another worker).
+    """
+    if _CACHE is not None and _CACHE["version"] < version and _REFRESH_LOCK.acquire(blocking=False):
+        try:
+            _adopt_shared_snapshot()
+        finally:
+            _REFRESH_LOCK.release()
+    return load_snapshot(observe)
+
+
+def snapshot_delta(since, snap):
+    """
+    /shifts/delta body taking a client from version `since` to `snap`. A
+    client ahead of `snap` (another worker served it) gets an empty delta
+    that keeps its version rather than a resync.
+    """
+    current = snap["version"]
+    out = {"version": current, "since": since, "full_resync": False}
+    if since >= current:
+        out.update(version=since, added=[], removed=[], modified=[])
+    else:
+        changes = changes_since(since, current)
+        if changes is None:
+            out["full_resync"] = True
+            return out
+        out.update(delta_json(*changes))
+    out["people"] = snap["people"]
+    return out
+
+
+@app.route("/shifts/delta")
+def shifts_delta():
+    """
+    Changes to /shifts.json since snapshot ?since=<version> (the
+    X-Snapshot-Version a client last saw), or full_resync when the change
+    log no longer reaches back that far.
+    """
+    try:
+        since = int(request.args["since"])
+    except (KeyError, ValueError):
+        return jsonify({"error": "missing or bad since"}), 400
+    return jsonify(snapshot_delta(since, catch_up_snapshot(since)))
+
+
+@app.route("/shifts/stream")
+def shifts_stream():
+    """
+    Server-sent events: a "delta" event (the /shifts/delta body, with the new
+    version as its id) whenever a snapshot is installed, and comment
+    heartbeats in between. Starts from ?since= or, on a reconnect, the
+    Last-Event-ID the browser sends back. A client ahead of this worker waits
+    for it to catch up. Over _STREAM_MAX_CLIENTS open streams the answer is
+    204, which tells EventSource not to reconnect.
+    """
+    global _STREAMS_OPEN
+    snap = load_snapshot()
+    try:
+        since = int(request.headers.get("Last-Event-ID") or request.args.get("since") or snap["version"])
+    except ValueError:
+        return jsonify({"error": "bad since"}), 400
+
+    with _STREAMS_LOCK:
+        full = _STREAMS_OPEN >= _STREAM_MAX_CLIENTS
+        if not full:
+            _STREAMS_OPEN += 1
+    if full:
+        metric_inc("tradeapp_streams_refused_total")
+        return app.response_class(status=204)
+
+    def release():
+        global _STREAMS_OPEN
+        with _STREAMS_LOCK:
+            _STREAMS_OPEN -= 1
+
+    def events(version):
+        yield "retry: 5000\n\n"
+        deadline = _time.monotonic() + _STREAM_MAX_SECONDS
+        beat = _time.monotonic()
+        while True:
+            # Not a client load: keep heartbeats out of tradeapp_snapshot_loads_total
+            snap = catch_up_snapshot(version, observe=False)  # also nudges the refresher when stale
+            if snap["version"] > version:
+                delta = snapshot_delta(version, snap)
+                version = snap["version"]
+                yield f"event: delta\nid: {version}\ndata: {app.json.dumps(delta)}\n\n"
+                beat = _time.monotonic()
+                continue
+            now = _time.monotonic()
+            if now >= deadline:
+                return
+            if now - beat >= _STREAM_HEARTBEAT_SECONDS:
+                yield ": keepalive\n\n"
+                beat = now
+            ahead = snap["version"] < version
+            with _SNAPSHOT_CHANGED:
+                _SNAPSHOT_CHANGED.wait_for(
+                    lambda: _CACHE["version"] > version,
+                    timeout=_STREAM_CATCH_UP_SECONDS if ahead else beat + _STREAM_HEARTBEAT_SECONDS - now)
+
+    resp = app.response_class(events(since), mimetype="text/event-stream")
+    resp.call_on_close(release)
+    resp.headers["Cache-Control"] = "no-cache"
+    resp.headers["X-Accel-Buffering"] = "no"  # don't let a proxy hold events back
+    return resp
+
+
+# -------------------------------
+# API: cache / fetch diagnostics
+# -------------------------------
+@app.route("/stats.json")
+def stats_json():
+    age = snapshot_age_seconds()
+    err = _LAST_REFRESH_ERROR
+    return jsonify({
+        "fetch": list(_LAST_FETCH_STATS),
+        "cache": dict(_CACHE_STATS),
+        "trade_options_cache": options_cache_stats(),
+        "snapshot": {
+            "version": _CACHE["version"] if _CACHE is not None else None,
+            "built_at": iso(_CACHE["ts"]) if _CACHE is not None else None,
+            "age_seconds": round(age, 1) if age is not None else None,
+            "stale": age is not None and age >= _CACHE_TTL_SECONDS,
+            "last_error": {"at": iso(err["at"]), "error": err["error"]} if err else None,
+        },
+    })
+
+
+@app.before_request
+def _start_request_timer():
+    g.request_started = _time.perf_counter()
+
+
+@app.after_request
+def _observe_request(resp):
+    started = g.pop("request_started", None)
+    if started is not None:
+        metric_observe("tradeapp_http_request_seconds", _time.perf_counter() - started,
+                       endpoint=request.endpoint or "unmatched", method=request.method, status=resp.status_code)
+    return resp
+
+
+@app.route("/metrics")
+def metrics():
+    """Prometheus text exposition: stage timers, feed and trade counters, cache stats."""
+    with _STATS_LOCK:
+        cache = dict(_CACHE_STATS)
+    opts = options_cache_stats()
+    snap = _CACHE
+    age = snapshot_age_seconds()
+    counters = [("tradeapp_snapshot_cache_events_total", "Snapshot refresh / coalescing events.", {"event": k}, v)
+                for k, v in sorted(cache.items())]
+    counters += [("tradeapp_trade_options_cache_total", "Trade-options result cache events.", {"event": k}, opts[k])
+                 for k in ("hits", "misses", "evictions", "invalidations")]
+    gauges = [("tradeapp_trade_options_cache_size", "Entries in the trade-options result cache.", {}, opts["size"]),
+              ("tradeapp_streams_open", "Open /shifts/stream connections.", {}, _STREAMS_OPEN)]
+    if snap is not None:
+        gauges += [
+            ("tradeapp_snapshot_age_seconds", "Age of the served snapshot.", {}, age),
+            ("tradeapp_snapshot_version", "Version stamp of the served snapshot.", {}, snap["version"]),
+            ("tradeapp_snapshot_shifts", "Future shifts in the served snapshot.", {}, len(snap["flat"])),
+        ]
+    return app.response_class(render_metrics(counters, gauges), mimetype="text/plain; version=0.0.4")
+
+
+# -------------------------------
+# Trade-options result cache (LRU)
+# -------------------------------
+def options_cache_get(key):
+    with _OPTIONS_LOCK:
+        payload = _OPTIONS_CACHE.get(key)
+        if payload is None:
+            _OPTIONS_STATS["misses"] += 1
+            return None
+        _OPTIONS_CACHE.move_to_end(key)
+        _OPTIONS_STATS["hits"] += 1
+        return payload
+
+def options_cache_put(key, payload):
+    with _OPTIONS_LOCK:
+        _OPTIONS_CACHE[key] = payload
+        _OPTIONS_CACHE.move_to_end(key)
+        while len(_OPTIONS_CACHE) > _OPTIONS_CACHE_SIZE:
+            _OPTIONS_CACHE.popitem(last=False)
+            _OPTIONS_STATS["evictions"] += 1
+
+def invalidate_options_cache():
+    with _OPTIONS_LOCK:
+        if _OPTIONS_CACHE:
+            _OPTIONS_CACHE.clear()
+            _OPTIONS_STATS["invalidations"] += 1
+
+def options_cache_stats():
+    with _OPTIONS_LOCK:
+        return dict(_OPTIONS_STATS, size=len(_OPTIONS_CACHE), capacity=_OPTIONS_CACHE_SIZE)
+
+
+# -------------------------------
+# Profiling hook
+# -------------------------------
+def profile_trigger():
+    """Why this request should be profiled ("token" / "sample"), or None."""
+    if _PROFILE_TOKEN:
+        given = request.headers.get("X-Profile-Token") or request.args.get("profile") or ""
+        if hmac.compare_digest(given.encode("utf-8"), _PROFILE_TOKEN.encode("utf-8")):
+            return "token"
+    if _PROFILE_SAMPLE_RATE > 0 and random.random() < _PROFILE_SAMPLE_RATE:
+        return "sample"
+    return None
+
+
+def save_profile(prof, seconds, info):
+    """Dump `prof` as info["name"] plus a small JSON sidecar into _PROFILE_DIR, then rotate."""
+    os.makedirs(_PROFILE_DIR, exist_ok=True)
+    base = os.path.join(_PROFILE_DIR, info["name"][:-len(".prof")])
+    prof.dump_stats(base + ".prof")
+    with open(base + ".json", "w") as f:
+        json.dump(dict(info, seconds=round(seconds, 6)), f)
+
+    dumps = sorted(n for n in os.listdir(_PROFILE_DIR) if n.endswith(".prof"))
+    for name in dumps[:max(0, len(dumps) - _PROFILE_KEEP)]:
+        for path in (name, name[:-len(".prof")] + ".json"):
+            try:
+                os.remove(os.path.join(_PROFILE_DIR, path))
+            except FileNotFoundError:
+                pass
+
+
+def profiled(view):
+    """
+    Run `view` under cProfile when profile_trigger() says so, with
+    g.profiling set so the view skips result caches. A streamed body is
+    captured too: the profiler runs around each chunk it produces, and the
+    dump is written when the response closes. X-Profile names the dump.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        trigger = profile_trigger()
+        if trigger is None or not _PROFILE_LOCK.acquire(blocking=False):
+            return view(*args, **kwargs)
+        # The request context is gone by the time a streamed body finishes
+        stamp = datetime.now(EASTERN).strftime("%Y%m%dT%H%M%S.%f")
+        info = {
+            "name": "%s-%s-%d.prof" % (stamp, request.endpoint, os.getpid()),
+            "endpoint": request.endpoint,
+            "trigger": trigger,
+            "at": iso(datetime.now(EASTERN)),
+            "snapshot_version": _CACHE["version"] if _CACHE is not None else None,
+            "request": request.get_json(force=True, silent=True),
+        }
+        prof = cProfile.Profile()
+        spent = [0.0]
+
+        def run(fn):
+            t0 = _time.perf_counter()
+            prof.enable()
+            try:
+                return fn()
+            finally:
+                prof.disable()
+                spent[0] += _time.perf_counter() - t0
+
+        def finish():
+            try:
+                save_profile(prof, spent[0], info)
+            except OSError as e:
+                app.logger.warning("could not write profile: %r", e)
+            finally:
+                _PROFILE_LOCK.release()
+
+        try:
+            g.profiling = True
+            resp = run(lambda: app.make_response(view(*args, **kwargs)))
+        except BaseException:
+            _PROFILE_LOCK.release()
+            raise
+        metric_inc("tradeapp_profiles_total", endpoint=request.endpoint, trigger=trigger)
+        resp.headers["X-Profile"] = info["name"]
+        if not resp.is_streamed:
+            finish()
+            return resp
+
+        body = iter(resp.response)
+
+        def captured():
+            try:
+                while True:
+                    chunk = run(lambda: next(body, None))
+                    if chunk is None:
+                        return
+                    yield chunk
+            finally:
+                if hasattr(body, "close"):
+                    body.close()
+
+        resp.response = captured()
+        resp.call_on_close(finish)
+        return resp
+    return wrapper
 
 
 # -------------------------------
 # API: trade options (future only)
 # -------------------------------
 @app.route("/trade-options", methods=["POST"])
+@profiled
 def trade_options():
     data = request.get_json(force=True, silent=True) or {}
     trader_person = data.get("trader_person")
@@ -293,43 +2338,126 @@ def trade_options():
     if not trader_person or not trader_shift_id:
         return jsonify({"error": "missing trader_person or trader_shift_id"}), 400
 
-    _, flat, schedules = load_data_cached()
+    snap = load_snapshot()
 
-    trader_shift = next((s for s in flat if s["id"] == trader_shift_id and s["person"] == trader_person), None)
-    if not trader_shift:
+    # Ids are strings; anything else (a list, an object) matches no shift
+    trader_shift = snap["by_id"].get(trader_shift_id) if isinstance(trader_shift_id, str) else None
+    if not trader_shift or trader_shift.person != trader_person:
         return jsonify({"error": "trader_shift not found"}), 404
 
+    key = (snap["version"], trader_shift_id)
+    payload = None if g.get("profiling") else options_cache_get(key)
+    if wants_ndjson():
+        return trade_options_stream(snap, trader_shift, key, payload)
+    if payload is not None:
+        return jsonify(payload)
+
     candidates = []
-    for sB in flat:
-        if sB["person"] == trader_person:
-            continue
-        ok, reason = simulate_swap_ok(schedules, trader_shift, sB)
-        if ok:
-            candidates.append({
-                "tradee_person": sB["person"],
-                "tradee_shift": {
-                    "id": sB["id"],
-                    "person": sB["person"],
-                    "title": sB["title"],
-                    "start": iso(sB["start"]),
-                    "end": iso(sB["end"]),
-                    "eligible": sB["eligible"],
-                },
-                "reason": reason
-            })
+    for sB, reason in trade_candidates(snap, trader_shift):
+        candidates.append(candidate_json(sB, reason))
 
     candidates.sort(key=lambda c: (c["tradee_shift"]["start"], c["tradee_person"]))
 
-    return jsonify({
-        "trader_shift": {
-            "id": trader_shift["id"],
-            "person": trader_shift["person"],
-            "title": trader_shift["title"],
-            "start": iso(trader_shift["start"]),
-            "end": iso(trader_shift["end"]),
-            "eligible": trader_shift["eligible"],
-        },
+    payload = {
+        "trader_shift": shift_json(trader_shift),
         "candidates": candidates
+    }
+    options_cache_put(key, payload)
+    return jsonify(payload)
+
+
+def candidate_json(sB, reason):
+    return {
+        "tradee_person": sB.person,
+        "tradee_shift": shift_json(sB),
+        "reason": reason
+    }
+
+
+def wants_ndjson():
+    if request.args.get("stream") == "1":
+        return True
+    best = request.accept_mimetypes.best_match(["application/json", "application/x-ndjson"])
+    return best == "application/x-ndjson"
+
+
+def trade_options_stream(snap, trader_shift, key, payload):
+    """
+    NDJSON variant of /trade-options: a {"trader_shift"} line, one line per
+    candidate in start order as it is validated, then {"done", "count"}.
+    A completed stream fills the same result cache as the JSON response.
+    """
+    def dumps(obj):
+        return app.json.dumps(obj) + "\n"
+
+    def lines():
+        yield dumps({"trader_shift": shift_json(trader_shift)})
+        if payload is not None:
+            for c in payload["candidates"]:
+                yield dumps(c)
+            yield dumps({"done": True, "count": len(payload["candidates"])})
+            return
+        candidates = []
+        for sB, reason in iter_trade_candidates(snap, trader_shift):
+            c = candidate_json(sB, reason)
+            candidates.append(c)
+            yield dumps(c)
+        yield dumps({"done": True, "count": len(candidates)})
+        candidates.sort(key=lambda c: (c["tradee_shift"]["start"], c["tradee_person"]))
+        options_cache_put(key, {"trader_shift": shift_json(trader_shift), "candidates": candidates})
+
+    resp = app.response_class(lines(), mimetype="application/x-ndjson")
+    resp.headers["Cache-Control"] = "no-cache"
+    resp.headers["X-Accel-Buffering"] = "no"
+    return resp
+
+
+# -------------------------------
+# API: all-pairs trade matrix
+# -------------------------------
+@app.route("/trade-matrix")
+def trade_matrix():
+    """
+    All-pairs summary, or ?shift_id= one trader's tradees, from the last
+    finished matrix. "version" is the snapshot it was built from and
+    "current" says whether that is the served one; 202 until the first build.
+    """
+    snap = load_snapshot()
+    m = get_trade_matrix(snap)
+    if m is None:
+        resp = jsonify({"building": True, "version": None, "snapshot_version": snap["version"]})
+        resp.status_code = 202
+        resp.headers["Retry-After"] = "5"
+        return resp
+    current = m["version"] == snap["version"]
+    shift_id = request.args.get("shift_id")
+    if not shift_id:
+        totals = [sum(col) for col in zip(*m["reason_counts"])] if m["reason_counts"] else []
+        return jsonify({
+            "version": m["version"],
+            "current": current,
+            "shifts": len(m["ids"]),
+            "traders": len(m["traders"]),
+            "pairs": len(m["indices"]),
+            "reasons": dict(zip(SWAP_REASONS, totals)),
+            "build_seconds": m["seconds"],
+            "workers": m["workers"],
+        })
+
+    row = m["row_of"].get(shift_id)
+    if row is None:
+        return jsonify({"error": "shift not found"}), 404
+    i = m["trader_pos"].get(row)
+    if i is None:
+        return jsonify({"version": m["version"], "current": current, "shift_id": shift_id, "tradee_ids": [],
+                        "reasons": {"ineligible-title": len(m["ids"])}})
+    lo, hi = m["indptr"][i], m["indptr"][i + 1]
+    return jsonify({
+        "version": m["version"],
+        "current": current,
+        "shift_id": shift_id,
+        "tradee_ids": [m["ids"][j] for j in m["indices"][lo:hi]],
+        "reasons": dict(zip(SWAP_REASONS, m["reason_counts"][i])),
     })
 
 
@@ -337,6 +2465,7 @@ def trade_options():
 # API: final recheck (future only)
 # -------------------------------
 @app.route("/trade-recheck", methods=["POST"])
+@profiled
 def trade_recheck():
     data = request.get_json(force=True, silent=True) or {}
     trader_shift_id = data.get("trader_shift_id")
@@ -344,13 +2473,15 @@ def trade_recheck():
     if not trader_shift_id or not tradee_shift_id:
         return jsonify({"error": "missing ids"}), 400
 
-    _, flat, schedules = load_data_cached()
-    sA = next((s for s in flat if s["id"] == trader_shift_id), None)
-    sB = next((s for s in flat if s["id"] == tradee_shift_id), None)
+    snap = load_snapshot()
+    by_id = snap["by_id"]
+    sA = by_id.get(trader_shift_id) if isinstance(trader_shift_id, str) else None
+    sB = by_id.get(tradee_shift_id) if isinstance(tradee_shift_id, str) else None
     if not sA or not sB:
         return jsonify({"ok": False, "reason": "not-found"}), 404
 
-    ok, reason = simulate_swap_ok(schedules, sA, sB)
+    ok, reason = simulate_swap_ok(snap["schedules"], sA, sB, snap["sched_index"])
+    metric_inc("tradeapp_trade_rechecks_total", reason=reason)
     return jsonify({"ok": ok, "reason": reason})
 
 
@@ -811,6 +2942,11 @@ INDEX_HTML = """
     let SHIFTS = [];
     let PEOPLE = [];
     let CURRENT_TRADE = null;
+    let SNAP_VERSION = null;
+    let STREAM = null;
+    let POLL = null;
+    let OPTIONS_ABORT = null;
+    let PARTNERS = new Set();  // people in the trade options on screen
 
     function fmt(dtiso){
       const d = new Date(dtiso);
@@ -835,13 +2971,13 @@ INDEX_HTML = """
       return badge;
     }
 
-    function selectMyShift(shiftId){
+    function selectMyShift(shiftId, refetch = true){
       if(!shiftId) return;
       myShiftSel.value = shiftId;
       document.querySelectorAll('#mine .card.selectable').forEach(c => {
         c.classList.toggle('is-selected', c.dataset.shiftId === shiftId);
       });
-      fetchOptions();
+      if (refetch) fetchOptions();
     }
 
     async function loadShifts(){
@@ -861,18 +2997,72 @@ INDEX_HTML = """
         loaderSub.textContent = "Preparing interface…";
         PEOPLE = data.people;
         SHIFTS = data.shifts; // already filtered to future by server
+        SNAP_VERSION = r.headers.get("X-Snapshot-Version");
         setLoader(86);
 
         populatePeople();
         populateMyShifts();
         await fetchOptions();
         hideLoader();
+        watchShifts();
       } catch (e){
         console.error(e);
         showLoaderError("Network error while loading schedules.");
       }
     }
 
+    // Live updates: the server pushes a delta whenever its snapshot changes.
+    // When it has no stream to spare (204) the tab polls /shifts/delta instead.
+    function watchShifts(){
+      if (STREAM) STREAM.close();
+      STREAM = null;
+      clearTimeout(POLL);
+      if (!SNAP_VERSION) return;
+      if (!window.EventSource){ pollShifts(); return; }
+      const es = STREAM = new EventSource(`/shifts/stream?since=${encodeURIComponent(SNAP_VERSION)}`);
+      es.addEventListener("delta", (e)=> onDelta(JSON.parse(e.data)));
+      es.onerror = ()=>{
+        if (es.readyState === EventSource.CLOSED && STREAM === es){ STREAM = null; pollShifts(); }
+      };
+    }
+
+    function pollShifts(){
+      clearTimeout(POLL);
+      POLL = setTimeout(async ()=>{
+        try{
+          const r = await fetch(`/shifts/delta?since=${encodeURIComponent(SNAP_VERSION)}`);
+          if (r.ok && onDelta(await r.json())) return;
+        } catch (e){
+          console.error(e);
+        }
+        pollShifts();
+      }, 60000);
+    }
+
+    // Returns true when it fell back to a full reload (which re-arms watching)
+    function onDelta(d){
+      if (d.full_resync){ loadShifts(); return true; }
+      SNAP_VERSION = String(d.version);
+      if (d.added.length || d.removed.length || d.modified.length) applyDelta(d);
+      return false;
+    }
+
+    function applyDelta(d){
+      const byId = new Map(SHIFTS.map(s => [s.id, s]));
+      const gone = d.removed.concat(d.modified.map(m => m.old_id));
+      const touched = new Set(d.added.concat(d.modified.map(m => m.shift)).map(s => s.person));
+      gone.forEach(id => { const s = byId.get(id); if (s) touched.add(s.person); });
+      const goneSet = new Set(gone);
+      SHIFTS = SHIFTS.filter(s => !goneSet.has(s.id))
+        .concat(d.added, d.modified.map(m => m.shift));
+      PEOPLE = d.people;
+      const me = meSel.value;
+      populatePeople();
+      if (PEOPLE.includes(me)) meSel.value = me;
+      // Trade options only need refetching when my shifts or my partners' moved
+      populateMyShifts(touched.has(meSel.value) || [...PARTNERS].some(p => touched.has(p)));
+    }
+
     function populatePeople(){
       meSel.innerHTML = "";
       PEOPLE.forEach(p=>{
@@ -886,9 +3076,10 @@ INDEX_HTML = """
       return SHIFTS.filter(s => s.person === person && s.eligible);
     }
 
-    function populateMyShifts(){
+    function populateMyShifts(refetch = true){
       const person = meSel.value;
       const mine = myEligibleShifts(person).sort((a,b)=>a.start.localeCompare(b.start));
+      const prev = myShiftSel.value;
       myShiftSel.innerHTML = "";
       mine.forEach(s=>{
         const f1 = fmt(s.start), f2 = fmt(s.end);
@@ -936,8 +3127,9 @@ INDEX_HTML = """
       });
 
       const firstId = mine[0]?.id;
-      const current = myShiftSel.value || firstId;
-      if (current) selectMyShift(current);
+      const current = mine.some(s => s.id === prev) ? prev : firstId;
+      if (current) selectMyShift(current, refetch || current !== prev);
+      else if (prev) fetchOptions();
     }
 
     // Build outreach message text
@@ -1128,86 +3320,117 @@ lmk and I’ll make it official 😎
         results.innerHTML = `<div class="empty">Select a shift above.</div>`;
         return;
       }
+      // Only the latest request may render; a newer selection aborts this one
+      if (OPTIONS_ABORT) OPTIONS_ABORT.abort();
+      const ctl = OPTIONS_ABORT = new AbortController();
+      PARTNERS = new Set();
       results.innerHTML = `<div class="muted">Finding valid trades…</div>`;
-      const r = await fetch("/trade-options",{
-        method:"POST",
-        headers: {"Content-Type":"application/json"},
-        body: JSON.stringify({ trader_person: person, trader_shift_id: shiftId })
-      });
+      let r;
+      try{
+        r = await fetch("/trade-options?stream=1",{
+          method:"POST",
+          headers: {"Content-Type":"application/json", "Accept":"application/x-ndjson"},
+          body: JSON.stringify({ trader_person: person, trader_shift_id: shiftId }),
+          signal: ctl.signal
+        });
+      } catch (e){
+        if (e.name !== "AbortError") results.innerHTML = `<div class="empty">Network error.</div>`;
+        return;
+      }
       if(!r.ok){
         const t = await r.text();
         results.innerHTML = `<div class="empty">Error: ${escapeHTML(t)}</div>`;
         return;
       }
-      const data = await r.json();
-      const all = data.candidates
-        .map(c => ({ partner: c.tradee_person, shift: c.tradee_shift }))
-        .sort((a,b)=> a.shift.start.localeCompare(b.shift.start));
-
-      results.innerHTML = "";
-      if (all.length === 0){
-        results.innerHTML = `<div class="empty">No valid trades found right now.</div>`;
-        return;
-      }
 
       const mine = SHIFTS.find(x => x.id === shiftId);
+      let count = 0;
+      const onLine = (line)=>{
+        if (!line) return;
+        const msg = JSON.parse(line);
+        if (msg.tradee_shift){
+          PARTNERS.add(msg.tradee_person);
+          if (count++ === 0) results.innerHTML = "";
+          renderCandidate(mine, msg.tradee_person, msg.tradee_shift);
+        } else if (msg.done && count === 0){
+          results.innerHTML = `<div class="empty">No valid trades found right now.</div>`;
+        }
+      };
 
-      all.forEach(({partner, shift: s})=>{
-        const f1 = fmt(s.start), f2 = fmt(s.end);
-        const dur = hoursBetweenISO(s.start, s.end).toFixed(1);
-
-        const card = document.createElement("div");
-        card.className = "card";
+      // Candidates arrive as NDJSON in start order; render each as it lands
+      try{
+        const reader = r.body.getReader();
+        const decoder = new TextDecoder();
+        let buf = "";
+        for(;;){
+          const {value, done} = await reader.read();
+          if (done) break;
+          buf += decoder.decode(value, {stream: true});
+          const lines = buf.split("\n");
+          buf = lines.pop();
+          lines.forEach(onLine);
+        }
+        onLine(buf);
+      } catch (e){
+        if (e.name !== "AbortError") throw e;
+      }
+    }
 
-        const meta = document.createElement("div");
-        meta.className = "meta";
-        const title = document.createElement("div");
-        title.className = "title";
-        title.textContent = s.title;
-        const subRow = document.createElement("div");
-        subRow.className = "sub";
-        subRow.textContent = `${f1.dstr} ${f1.t} · ${f2.t} • ${dur}h`;
-        const wk = weekendBadgeEl(s.start);
-        if (wk){ subRow.appendChild(document.createTextNode(" ")); subRow.appendChild(wk); }
-        meta.appendChild(title); meta.appendChild(subRow);
+    function renderCandidate(mine, partner, s){
+      const f1 = fmt(s.start), f2 = fmt(s.end);
+      const dur = hoursBetweenISO(s.start, s.end).toFixed(1);
+
+      const card = document.createElement("div");
+      card.className = "card";
+
+      const meta = document.createElement("div");
+      meta.className = "meta";
+      const title = document.createElement("div");
+      title.className = "title";
+      title.textContent = s.title;
+      const subRow = document.createElement("div");
+      subRow.className = "sub";
+      subRow.textContent = `${f1.dstr} ${f1.t} · ${f2.t} • ${dur}h`;
+      const wk = weekendBadgeEl(s.start);
+      if (wk){ subRow.appendChild(document.createTextNode(" ")); subRow.appendChild(wk); }
+      meta.appendChild(title); meta.appendChild(subRow);
+
+      const offer = document.createElement("button");
+      offer.className = "offer";
+      offer.textContent = "Offer";
+      offer.onclick = async ()=>{
+        // Keep your global loader during validation for now
+        showLoader("Validating trade…");
+
+        const r2 = await fetch("/trade-recheck",{
+          method:"POST",
+          headers: {"Content-Type":"application/json"},
+          body: JSON.stringify({ trader_shift_id: mine.id, tradee_shift_id: s.id })
+        });
+        const data2 = await r2.json();
+
+        if (data2.ok){
+          const me = meSel.value;
+          CURRENT_TRADE = { me, partner, myShift: mine, theirShift: s };
+
+          // Build comparison (Option A) and message
+          renderOptionAComparison(CURRENT_TRADE);
+          msgbox.value = buildMessage("professional", me, partner, mine, s);
+          [tonePro, toneDes, toneSil].forEach(btn => btn.setAttribute("aria-pressed", "false"));
+          tonePro.setAttribute("aria-pressed","true");
+          setCopyState(false);
+
+          hideLoader();
+          modal.style.display = "flex";
+        } else {
+          hideLoader();
+          alert("This pair failed recheck: " + data2.reason);
+        }
+      };
 
-        const offer = document.createElement("button");
-        offer.className = "offer";
-        offer.textContent = "Offer";
-        offer.onclick = async ()=>{
-          // Keep your global loader during validation for now
-          showLoader("Validating trade…");
-
-          const r2 = await fetch("/trade-recheck",{
-            method:"POST",
-            headers: {"Content-Type":"application/json"},
-            body: JSON.stringify({ trader_shift_id: mine.id, tradee_shift_id: s.id })
-          });
-          const data2 = await r2.json();
-
-          if (data2.ok){
-            const me = meSel.value;
-            CURRENT_TRADE = { me, partner, myShift: mine, theirShift: s };
-
-            // Build comparison (Option A) and message
-            renderOptionAComparison(CURRENT_TRADE);
-            msgbox.value = buildMessage("professional", me, partner, mine, s);
-            [tonePro, toneDes, toneSil].forEach(btn => btn.setAttribute("aria-pressed", "false"));
-            tonePro.setAttribute("aria-pressed","true");
-            setCopyState(false);
-
-            hideLoader();
-            modal.style.display = "flex";
-          } else {
-            hideLoader();
-            alert("This pair failed recheck: " + data2.reason);
-          }
-        };
-
-        card.appendChild(meta);
-        card.appendChild(offer);
-        results.appendChild(card);
-      });
+      card.appendChild(meta);
+      card.appendChild(offer);
+      results.appendChild(card);
     }
 
     /* Listeners */
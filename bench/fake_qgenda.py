@@ -0,0 +1,176 @@
+# bench/fake_qgenda.py
+"""
+Local stand-in for QGenda's iCal export, serving bench/feeds.py bodies.
+
+    python bench/fake_qgenda.py --people 40 --port 8765 --latency 150 \\
+        --error-rate 0.02 --write-calendars /tmp/calendars.json
+    CALENDARS_PATH=/tmp/calendars.json python app.py
+
+Feeds live at /ical?key=<n>. Responses carry a strong ETag and
+Last-Modified and answer If-None-Match with 304, like the real thing.
+Knobs: --latency/--jitter (ms before the status line), --error-rate (share
+of 500/503 answers), --slow-body (bytes per second the body is dribbled out
+at) and --mutate-every (seconds between edits to a random feed, so
+refreshes see real changes).
+"""
+import argparse, hashlib, json, random, sys, threading, os
+import time as _time
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bench.feeds import make_feed, person_names  # noqa: E402
+
+
+class FeedStore:
+    """Current body, ETag and Last-Modified per feed key."""
+
+    def __init__(self, people, seed=0, **feed_kw):
+        self.lock = threading.Lock()
+        self.names = person_names(people)
+        self.seed = seed
+        self.feed_kw = feed_kw
+        self.revision = {}
+        self.feeds = {}
+        for key in range(people):
+            self._render(key)
+
+    def _render(self, key):
+        rev = self.revision.get(key, 0)
+        seed = self.seed if rev == 0 else "%s.%d" % (self.seed, rev)
+        body = make_feed(self.names[key], seed=seed, **self.feed_kw).encode("utf-8")
+        self.feeds[key] = {
+            "body": body,
+            "etag": '"%s"' % hashlib.sha1(body).hexdigest(),
+            "last_modified": formatdate(usegmt=True),
+        }
+
+    def get(self, key):
+        with self.lock:
+            return self.feeds.get(key)
+
+    def mutate(self, rnd):
+        """Regenerate one random feed (a schedule edit upstream)."""
+        key = rnd.randrange(len(self.names))
+        with self.lock:
+            self.revision[key] = self.revision.get(key, 0) + 1
+            self._render(key)
+        return key
+
+    def calendars(self, base_url):
+        return [{"name": name, "url": "%s/ical?key=%d" % (base_url, key)} for key, name in enumerate(self.names)]
+
+
+def make_handler(store, opts):
+    rnd = random.Random(opts.seed)
+    lock = threading.Lock()
+    stats = {"200": 0, "304": 0, "error": 0}
+
+    def count(outcome):
+        with lock:
+            stats[outcome] += 1
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, fmt, *args):
+            if opts.verbose:
+                super().log_message(fmt, *args)
+
+        def do_GET(self):
+            with lock:
+                delay = max(0.0, rnd.gauss(opts.latency, opts.jitter)) / 1000.0
+                fail = rnd.random() < opts.error_rate
+                code = rnd.choice((500, 503))
+            _time.sleep(delay)
+
+            url = urlparse(self.path)
+            if url.path == "/stats":
+                return self._send(200, json.dumps(stats).encode(), "application/json")
+            try:
+                feed = store.get(int(parse_qs(url.query)["key"][0]))
+            except (KeyError, ValueError):
+                feed = None
+            if url.path != "/ical" or feed is None:
+                return self._send(404, b"no such feed\n", "text/plain")
+            if fail:
+                count("error")
+                return self._send(code, b"injected failure\n", "text/plain")
+
+            headers = {"ETag": feed["etag"], "Last-Modified": feed["last_modified"]}
+            if self.headers.get("If-None-Match") == feed["etag"]:
+                count("304")
+                return self._send(304, b"", None, headers)
+            count("200")
+            self._send(200, feed["body"], "text/calendar; charset=utf-8", headers, slow=opts.slow_body)
+
+        def _send(self, code, body, ctype, headers=None, slow=0):
+            self.send_response(code)
+            if ctype:
+                self.send_header("Content-Type", ctype)
+            for k, v in (headers or {}).items():
+                self.send_header(k, v)
+            if code != 304:
+                self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            if not body:
+                return
+            if not slow:
+                self.wfile.write(body)
+                return
+            chunk = max(1, int(slow / 10))  # ten writes per second
+            for i in range(0, len(body), chunk):
+                self.wfile.write(body[i:i + chunk])
+                self.wfile.flush()
+                _time.sleep(0.1)
+
+    return Handler
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8765)
+    ap.add_argument("--people", type=int, default=40)
+    ap.add_argument("--horizon", type=int, default=120)
+    ap.add_argument("--history", type=int, default=365)
+    ap.add_argument("--density", type=float, default=4.0)
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--latency", type=float, default=0.0, help="mean ms before responding")
+    ap.add_argument("--jitter", type=float, default=0.0, help="latency std-dev in ms")
+    ap.add_argument("--error-rate", type=float, default=0.0)
+    ap.add_argument("--slow-body", type=int, default=0, help="body bytes per second (0 = full speed)")
+    ap.add_argument("--mutate-every", type=float, default=0.0, help="seconds between feed edits")
+    ap.add_argument("--write-calendars", help="write a calendars.json pointing at this server")
+    ap.add_argument("--verbose", action="store_true")
+    opts = ap.parse_args(argv)
+
+    store = FeedStore(opts.people, seed=opts.seed, horizon_days=opts.horizon,
+                      history_days=opts.history, density=opts.density)
+    server = ThreadingHTTPServer((opts.host, opts.port), make_handler(store, opts))
+    server.daemon_threads = True
+    base_url = "http://%s:%d" % (opts.host, server.server_address[1])
+    if opts.write_calendars:
+        with open(opts.write_calendars, "w") as f:
+            json.dump(store.calendars(base_url), f, indent=2)
+
+    if opts.mutate_every > 0:
+        def mutator():
+            rnd = random.Random(opts.seed + 1)
+            while True:
+                _time.sleep(opts.mutate_every)
+                print("mutated feed %d" % store.mutate(rnd), flush=True)
+        threading.Thread(target=mutator, daemon=True).start()
+
+    print("serving %d feeds on %s" % (opts.people, base_url), flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
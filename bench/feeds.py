@@ -0,0 +1,86 @@
+# bench/feeds.py
+"""
+Deterministic QGenda-style iCal feeds for benchmarks and load tests.
+
+Every feed is a pure function of (seed, person, options): the same arguments
+always give byte-identical bodies, so results can be compared across commits.
+"""
+import random
+from datetime import date, datetime, timedelta
+
+# (title, start hour, length in hours, relative weight). Mirrors the titles
+# the eligibility rules in app.py care about, ineligible ones included.
+SHIFT_TYPES = [
+    ("D1", 7, 9, 6), ("D2", 7, 9, 5), ("D3", 8, 9, 4),
+    ("E1", 15, 9, 5), ("E2", 15, 9, 5), ("E3", 16, 9, 3),
+    ("N1", 23, 8, 4), ("N2", 23, 8, 4), ("N3", 23, 8, 3),
+    ("Pod A 1", 10, 10, 3), ("Pod A 2", 10, 10, 2),
+    ("Pod B 1", 12, 10, 3), ("Pod B 2", 12, 10, 2),
+    ("Day 2", 7, 9, 1), ("Evening 1", 15, 9, 1), ("Night 3", 23, 8, 1),
+    ("Side", 11, 8, 1),
+    ("Trauma", 7, 12, 2), ("Trauma Night", 19, 12, 1),
+    ("US", 8, 8, 2), ("Ultrasound QA", 13, 4, 1),
+    ("Sick Call", None, 24, 2),  # all-day (VALUE=DATE)
+]
+_WEIGHTS = [w for *_, w in SHIFT_TYPES]
+
+TZID = "America/New_York"
+_DESCRIPTION = ("Scheduled via QGenda. Please contact the scheduling office for any "
+                "changes to this assignment; swaps must be approved in advance.")
+
+
+def fold(line):
+    """RFC 5545 line folding: 75 octets, continuation lines start with a space."""
+    out = []
+    while len(line) > 75:
+        out.append(line[:75])
+        line = " " + line[75:]
+    out.append(line)
+    return "\r\n".join(out)
+
+
+def person_names(count):
+    return ["Person %03d" % i for i in range(count)]
+
+
+def make_feed(person, seed=0, anchor=None, horizon_days=120, history_days=365, density=4.0):
+    """
+    One person's feed: on average `density` shifts per week from
+    `history_days` before `anchor` (default today) to `horizon_days` after.
+    History matters: the app parses it and throws it away on every refresh.
+    """
+    anchor = anchor or date.today()
+    rnd = random.Random("%s|%s" % (seed, person))
+    p = min(1.0, density / 7.0)
+    stamp = "20240101T000000Z"
+    lines = ["BEGIN:VCALENDAR", "VERSION:2.0", "PRODID:-//QGenda//Schedule Export//EN",
+             "CALSCALE:GREGORIAN", "X-WR-CALNAME:" + person]
+
+    day = anchor - timedelta(days=history_days)
+    last = anchor + timedelta(days=horizon_days)
+    n = 0
+    while day < last:
+        if rnd.random() < p:
+            title, hour, hours, _ = rnd.choices(SHIFT_TYPES, weights=_WEIGHTS)[0]
+            lines += ["BEGIN:VEVENT", "UID:%s-%d@bench.qgenda" % (person.replace(" ", ""), n), "DTSTAMP:" + stamp]
+            if hour is None:
+                lines += ["DTSTART;VALUE=DATE:" + day.strftime("%Y%m%d"),
+                          "DTEND;VALUE=DATE:" + (day + timedelta(days=1)).strftime("%Y%m%d")]
+            else:
+                start = datetime.combine(day, datetime.min.time()) + timedelta(hours=hour)
+                end = start + timedelta(hours=hours)
+                lines += ["DTSTART;TZID=%s:%s" % (TZID, start.strftime("%Y%m%dT%H%M%S")),
+                          "DTEND;TZID=%s:%s" % (TZID, end.strftime("%Y%m%dT%H%M%S"))]
+            lines += ["SUMMARY:" + title,
+                      fold("DESCRIPTION:%s (%s)" % (_DESCRIPTION, title)),
+                      "LOCATION:Main ED",
+                      "END:VEVENT"]
+            n += 1
+        day += timedelta(days=1)
+    lines.append("END:VCALENDAR")
+    return "\r\n".join(lines) + "\r\n"
+
+
+def make_feeds(people=40, seed=0, **kw):
+    """{name: feed body} for `people` generated people."""
+    return {name: make_feed(name, seed=seed, **kw) for name in person_names(people)}
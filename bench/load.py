@@ -0,0 +1,164 @@
+# bench/load.py
+"""
+Load driver: replays a /shifts.json, /trade-options, /trade-recheck mix
+against a running app and reports latency percentiles and throughput.
+
+    python bench/fake_qgenda.py --people 40 --latency 150 --write-calendars /tmp/cal.json &
+    CALENDARS_PATH=/tmp/cal.json python app.py &
+    python bench/load.py --url http://127.0.0.1:5002 --clients 16 --duration 60
+
+Each client thread behaves like an open tab: it mostly revalidates
+/shifts.json with If-None-Match, asks for trade options for one of the
+eligible shifts and rechecks some of the returned pairs. --mix sets the
+relative weights. Output is JSON: per endpoint count, errors, status
+counts, p50/p95/p99/max milliseconds and requests per second.
+"""
+import argparse, json, math, random, statistics, sys, threading
+import time as _time
+from collections import Counter, defaultdict
+
+import requests
+
+ENDPOINTS = ("shifts", "options", "recheck")
+
+
+def parse_mix(text):
+    mix = dict.fromkeys(ENDPOINTS, 0.0)
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        if name not in mix:
+            raise argparse.ArgumentTypeError("unknown endpoint %r (use %s)" % (name, "/".join(ENDPOINTS)))
+        mix[name] = float(weight)
+    return mix
+
+
+def percentile(sorted_ms, q):
+    if not sorted_ms:
+        return None
+    k = max(0, math.ceil(q / 100.0 * len(sorted_ms)) - 1)  # nearest rank
+    return round(sorted_ms[k], 2)
+
+
+class Recorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ms = defaultdict(list)
+        self.status = defaultdict(Counter)
+        self.errors = Counter()
+
+    def add(self, endpoint, ms, status):
+        with self.lock:
+            self.ms[endpoint].append(ms)
+            self.status[endpoint][str(status)] += 1
+            if status == "error" or int(status) >= 400:
+                self.errors[endpoint] += 1
+
+    def report(self, seconds):
+        out = {}
+        for name in ENDPOINTS:
+            ms = sorted(self.ms.get(name, []))
+            out[name] = {
+                "count": len(ms),
+                "errors": self.errors[name],
+                "status": dict(self.status[name]),
+                "rps": round(len(ms) / seconds, 2) if seconds else None,
+                "mean_ms": round(statistics.fmean(ms), 2) if ms else None,
+                "p50_ms": percentile(ms, 50),
+                "p95_ms": percentile(ms, 95),
+                "p99_ms": percentile(ms, 99),
+                "max_ms": round(ms[-1], 2) if ms else None,
+            }
+        total = sum(v["count"] for v in out.values())
+        out["total"] = {"count": total, "rps": round(total / seconds, 2) if seconds else None}
+        return out
+
+
+def client(base, mix, deadline, think, rec, seed):
+    rnd = random.Random(seed)
+    session = requests.Session()
+    names, weights = zip(*mix.items())
+    etag = None
+    mine = []        # this tab's eligible shifts
+    pairs = []       # (trader id, tradee id) seen in options answers
+
+    def timed(endpoint, fn):
+        t0 = _time.perf_counter()
+        try:
+            r = fn()
+            status = r.status_code
+        except requests.RequestException:
+            r, status = None, "error"
+        rec.add(endpoint, (_time.perf_counter() - t0) * 1000.0, status)
+        return r
+
+    def load_shifts():
+        nonlocal etag, mine
+        headers = {"If-None-Match": etag} if etag else {}
+        r = timed("shifts", lambda: session.get(base + "/shifts.json", headers=headers, timeout=60))
+        if r is not None and r.status_code == 200:
+            etag = r.headers.get("ETag")
+            shifts = [s for s in r.json()["shifts"] if s["eligible"]]
+            if shifts:
+                person = rnd.choice(shifts)["person"]
+                mine = [s for s in shifts if s["person"] == person]
+
+    load_shifts()
+    while _time.time() < deadline:
+        what = rnd.choices(names, weights=weights)[0]
+        if what == "shifts" or not mine:
+            load_shifts()
+        elif what == "options" or not pairs:
+            s = rnd.choice(mine)
+            r = timed("options", lambda: session.post(
+                base + "/trade-options", json={"trader_person": s["person"], "trader_shift_id": s["id"]}, timeout=60))
+            if r is not None and r.status_code == 200:
+                cands = r.json()["candidates"]
+                pairs = [(s["id"], c["tradee_shift"]["id"]) for c in rnd.sample(cands, min(10, len(cands)))]
+        else:
+            a, b = rnd.choice(pairs)
+            timed("recheck", lambda: session.post(
+                base + "/trade-recheck", json={"trader_shift_id": a, "tradee_shift_id": b}, timeout=60))
+        if think:
+            _time.sleep(rnd.expovariate(1.0 / think))
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    ap.add_argument("--url", default="http://127.0.0.1:5002")
+    ap.add_argument("--clients", type=int, default=8)
+    ap.add_argument("--duration", type=float, default=30.0, help="seconds")
+    ap.add_argument("--mix", type=parse_mix, default=parse_mix("shifts=5,options=3,recheck=2"))
+    ap.add_argument("--think", type=float, default=0.0, help="mean seconds between a client's requests")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--out", help="write JSON here instead of stdout")
+    args = ap.parse_args(argv)
+
+    base = args.url.rstrip("/")
+    rec = Recorder()
+    t0 = _time.time()
+    deadline = t0 + args.duration
+    threads = [threading.Thread(target=client, args=(base, args.mix, deadline, args.think, rec, args.seed + i),
+                                daemon=True) for i in range(args.clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = _time.time() - t0
+
+    doc = {
+        "params": {"url": base, "clients": args.clients, "duration": args.duration,
+                   "mix": args.mix, "think": args.think, "seed": args.seed},
+        "seconds": round(elapsed, 2),
+        "endpoints": rec.report(elapsed),
+    }
+    text = json.dumps(doc, indent=2)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    return 0 if not sum(rec.errors.values()) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
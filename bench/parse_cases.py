@@ -0,0 +1,113 @@
+# bench/parse_cases.py
+"""
+Parity check of the streaming iCal reader against Calendar.from_ical on
+edge-case feeds, DST cutoffs and generated feeds.
+
+    python bench/parse_cases.py                 # edge cases + 10 generated feeds
+    python bench/parse_cases.py --write /tmp/ics  # also dump the edge cases as .ics
+    flask --app app check-parse /tmp/ics/*.ics --live
+
+Run it after any change to stream_calendar_shifts(): every case must agree,
+including the ones that fall back to the full parser (RRULE, quoted TZID,
+missing DTEND, ...) or that both parsers reject. Exits 1 on a mismatch.
+"""
+import argparse, os, sys
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("SHIFT_BG_REFRESH", "0")
+os.environ.setdefault("SHIFT_SNAPSHOT_PATH", "")
+os.environ.setdefault("CALENDARS_PATH", os.path.join(ROOT, "calendars.json"))
+
+import app  # noqa: E402
+from bench.feeds import make_feeds  # noqa: E402
+
+# Either side of the 2030 DST switches (Mar 10, Nov 3) and mid-year
+CUTOFF_DAYS = [(2030, 3, 9), (2030, 3, 10), (2030, 6, 2), (2030, 11, 2), (2030, 11, 3)]
+
+
+def ics(*events):
+    """A VCALENDAR around `events`, each a list of VEVENT content lines."""
+    lines = ["BEGIN:VCALENDAR", "VERSION:2.0", "PRODID:-//TradeApp//check-parse//EN"]
+    for ev in events:
+        lines += ["BEGIN:VEVENT", "UID:%d@check-parse" % len(lines), "DTSTAMP:20240101T000000Z"]
+        lines += ev
+        lines.append("END:VEVENT")
+    lines.append("END:VCALENDAR")
+    return "\r\n".join(lines) + "\r\n"
+
+
+def edge_cases():
+    """
+    {label: iCal body} edge cases for app.check_parse_parity(): DST gaps and
+    overlaps, UTC / floating / all-day / other-zone times, folding, escapes,
+    and every construct that sends the streaming reader to the full parser.
+    Dates are in 2030 so they stay in the future.
+    """
+    ny = "TZID=America/New_York:"
+    return {
+        "times": ics(
+            ["SUMMARY:N1", "DTSTART;" + ny + "20300309T230000", "DTEND;" + ny + "20300310T070000"],
+            ["SUMMARY:D1", "DTSTART;" + ny + "20300310T023000", "DTEND;" + ny + "20300310T090000"],  # spring gap
+            ["SUMMARY:N2", "DTSTART;" + ny + "20301102T230000", "DTEND;" + ny + "20301103T070000"],
+            ["SUMMARY:D2", "DTSTART;" + ny + "20301103T013000", "DTEND;" + ny + "20301103T090000"],  # fall overlap
+            ["SUMMARY:E1", "DTSTART:20300601T190000Z", "DTEND:20300602T040000Z"],
+            ["SUMMARY:D3", "DTSTART:20300602T070000", "DTEND:20300602T160000"],
+            ["SUMMARY:Sick Call", "DTSTART;VALUE=DATE:20300603", "DTEND;VALUE=DATE:20300604"],
+            ["SUMMARY:US", "DTSTART;TZID=America/Los_Angeles:20300604T050000",
+             "DTEND;TZID=America/Los_Angeles:20300604T130000"],
+            ["SUMMARY:Backwards", "DTSTART;" + ny + "20300605T170000", "DTEND;" + ny + "20300605T080000"],
+            ["summary:E2", "dtstart;tzid=America/New_York:20300606T150000", "dtend;tzid=America/New_York:20300607T000000"],
+        ),
+        "escaped-summary": ics(
+            ["SUMMARY:Pod A 1\\, backup\\; page first\\nthen call \\\\ desk",
+             "DTSTART;" + ny + "20300701T100000", "DTEND;" + ny + "20300701T200000"],
+            ["SUMMARY:Trauma Night coverage for the main emergency department and the sa",
+             " tellite site", "DTSTART;" + ny + "20300702T190000", "DTEND;" + ny + "20300703T070000"],
+        ),
+        "rrule": ics(
+            ["SUMMARY:D1", "DTSTART;" + ny + "20300801T070000", "DTEND;" + ny + "20300801T160000",
+             "RRULE:FREQ=DAILY;COUNT=3"],
+        ),
+        "valarm-duration": ics(
+            ["SUMMARY:E3", "DTSTART;" + ny + "20300802T160000", "DTEND;" + ny + "20300803T010000",
+             "BEGIN:VALARM", "ACTION:DISPLAY", "DESCRIPTION:Shift soon", "TRIGGER:-PT30M",
+             "DURATION:PT5M", "REPEAT:2", "END:VALARM"],
+        ),
+        "quoted-tzid": ics(
+            ["SUMMARY:D2", 'DTSTART;TZID="America/New_York":20300803T070000',
+             'DTEND;TZID="America/New_York":20300803T160000'],
+        ),
+        "missing-dtend": ics(
+            ["SUMMARY:D3", "DTSTART;" + ny + "20300804T080000"],
+        ),
+        "duration": ics(
+            ["SUMMARY:N3", "DTSTART;" + ny + "20300805T230000", "DURATION:PT8H"],
+        ),
+    }
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    ap.add_argument("--generated", type=int, default=10, help="bench/feeds.py feeds to add")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--write", metavar="DIR", help="also write the edge cases as DIR/<label>.ics")
+    args = ap.parse_args(argv)
+
+    feeds = edge_cases()
+    if args.write:
+        os.makedirs(args.write, exist_ok=True)
+        for label, body in feeds.items():
+            with open(os.path.join(args.write, label + ".ics"), "w", newline="") as f:
+                f.write(body)
+    feeds.update(make_feeds(args.generated, seed=args.seed))
+
+    cutoffs = [app.future_cutoff()] + [app.EASTERN.localize(datetime(*d)) for d in CUTOFF_DAYS]
+    rows = app.check_parse_parity(feeds, cutoffs)
+    print("\n".join(app.parse_parity_report(rows)))
+    return 0 if all(r["ok"] for r in rows) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,204 @@
+# bench/run.py
+"""
+Timing and memory benchmarks for the shift pipeline on generated feeds.
+
+    python bench/run.py --people 40 --horizon 120 --density 4 --out bench.json
+
+Stages: parse (parse_calendar_shifts per feed), normalize (normalize_shifts
+with the network replaced by the generated bodies), index (install_snapshot),
+incremental (normalize_shifts + install_snapshot after one feed changed),
+swap (simulate_swap_ok on random pairs), trade_options (POST /trade-options
+per engine, cache cleared) and all_pairs (build_trade_matrix). Each stage
+reports min / median / mean seconds over --repeat runs; parse and normalize
+also report tracemalloc peak bytes. Output is one JSON document.
+"""
+import argparse, json, os, platform, random, statistics, subprocess, sys, tracemalloc
+import time as _time
+from datetime import date
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+# No background thread, no snapshot file, and the real calendars.json is
+# only read for the module-level config, never fetched.
+os.environ.setdefault("SHIFT_BG_REFRESH", "0")
+os.environ.setdefault("SHIFT_SNAPSHOT_PATH", "")
+os.environ.setdefault("CALENDARS_PATH", os.path.join(ROOT, "calendars.json"))
+
+import app  # noqa: E402
+from bench.feeds import make_feed, make_feeds  # noqa: E402
+
+
+def timed(fn, repeat):
+    """Run fn() `repeat` times; returns (summary dict, last result)."""
+    runs = []
+    result = None
+    for _ in range(repeat):
+        t0 = _time.perf_counter()
+        result = fn()
+        runs.append(_time.perf_counter() - t0)
+    return {
+        "runs": repeat,
+        "min_s": round(min(runs), 6),
+        "median_s": round(statistics.median(runs), 6),
+        "mean_s": round(statistics.fmean(runs), 6),
+    }, result
+
+
+def peak_bytes(fn):
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def use_feeds(bodies):
+    """Point app at the generated feeds: fetch_calendar returns their bodies."""
+    app.calendars[:] = [{"name": name, "url": "bench://" + name} for name in bodies]
+
+    def fetch_calendar(cal, start_cutoff=None):
+        return bodies[cal["name"]], 0.0, {}
+    app.fetch_calendar = fetch_calendar
+
+
+def build_snapshot():
+    app._FEED_STATE.clear()
+    cutoff = app.future_cutoff()
+    people, flat, schedules = app.normalize_shifts(cutoff)
+    return {
+        "version": app._next_version(),
+        "ts": app.datetime.now(app.EASTERN),
+        "cutoff": cutoff,
+        "people": people,
+        "flat": flat,
+        "schedules": schedules,
+    }
+
+
+def run(args):
+    bodies = make_feeds(args.people, seed=args.seed, anchor=args.anchor, horizon_days=args.horizon,
+                        history_days=args.history, density=args.density)
+    use_feeds(bodies)
+    cutoff = app.future_cutoff()
+    results = {}
+
+    def parse_all():
+        return [app.parse_calendar_shifts(name, body, cutoff) for name, body in bodies.items()]
+    parse_peak = peak_bytes(parse_all)
+    results["parse"], parsed = timed(parse_all, args.repeat)
+    results["parse"]["peak_bytes"] = parse_peak
+    results["parse"]["events_kept"] = sum(len(x) for x in parsed)
+
+    # Memory first: the last timed run's shifts are the ones _FEED_STATE keeps
+    normalize_peak = peak_bytes(build_snapshot)
+    results["normalize"], snap = timed(build_snapshot, args.repeat)
+    results["normalize"]["peak_bytes"] = normalize_peak
+
+    def index():
+        fresh = dict(snap, version=app._next_version(), ts=app.datetime.now(app.EASTERN))
+        app.install_snapshot(fresh)
+        return fresh
+    results["index"], snap = timed(index, args.repeat)
+
+    # One person's feed flips between two versions on every run
+    person = next(iter(bodies))
+    variants = [bodies[person], make_feed(person, seed=args.seed + 1, anchor=args.anchor, horizon_days=args.horizon,
+                                          history_days=args.history, density=args.density)]
+    flips = iter(range(1, 1 << 30))
+
+    def incremental():
+        bodies[person] = variants[next(flips) % 2]
+        cutoff = app._CACHE["cutoff"]
+        people, flat, schedules = app.normalize_shifts(cutoff, previous=app._CACHE)
+        app.install_snapshot({"version": app._next_version(), "ts": app.datetime.now(app.EASTERN),
+                              "cutoff": cutoff, "people": people, "flat": flat, "schedules": schedules})
+        return app._CACHE
+    results["incremental"], snap = timed(incremental, args.repeat)
+    results["incremental"]["changed_feeds"] = 1
+
+    rnd = random.Random(args.seed)
+    flat = snap["flat"]
+    pairs = [(rnd.choice(flat), rnd.choice(flat)) for _ in range(args.pairs)] if flat else []
+
+    def swaps():
+        for a, b in pairs:
+            app.simulate_swap_ok(snap["schedules"], a, b, snap["sched_index"])
+    results["swap"], _ = timed(swaps, args.repeat)
+    results["swap"]["pairs"] = len(pairs)
+    results["swap"]["per_call_us"] = round(results["swap"]["median_s"] / max(1, len(pairs)) * 1e6, 3)
+
+    traders = [s for s in flat if s.eligible]
+    traders = rnd.sample(traders, min(args.traders, len(traders)))
+    client = app.app.test_client()
+    engines = ["scalar"] + (["vector"] if app.np is not None else [])
+    for engine in engines:
+        def options():
+            app._TRADE_ENGINE = engine
+            n = 0
+            for s in traders:
+                app.invalidate_options_cache()
+                r = client.post("/trade-options", json={"trader_person": s.person, "trader_shift_id": s.id})
+                n += len(r.get_json()["candidates"])
+            return n
+        key = "trade_options_" + engine
+        results[key], n = timed(options, args.repeat)
+        results[key]["requests"] = len(traders)
+        results[key]["candidates"] = n
+        results[key]["per_request_ms"] = round(results[key]["median_s"] / max(1, len(traders)) * 1e3, 3)
+
+    if not args.skip_all_pairs:
+        app._TRADE_ENGINE = "auto"
+        results["all_pairs"], m = timed(lambda: app.build_trade_matrix(snap, workers=args.workers), 1)
+        results["all_pairs"].update(pairs=len(m["indices"]), workers=m["workers"])
+
+    return {
+        "meta": {
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "numpy": getattr(app.np, "__version__", None),
+            "cpus": os.cpu_count(),
+            "at": app.iso(app.datetime.now(app.EASTERN)),
+            "params": {k: (v.isoformat() if isinstance(v, date) else v) for k, v in vars(args).items() if k != "out"},
+            "feed_bytes": sum(len(b) for b in bodies.values()),
+            "shifts": len(flat),
+        },
+        "results": results,
+    }
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    ap.add_argument("--people", type=int, default=40)
+    ap.add_argument("--horizon", type=int, default=120, help="days of future shifts per feed")
+    ap.add_argument("--history", type=int, default=365, help="days of past shifts per feed")
+    ap.add_argument("--density", type=float, default=4.0, help="shifts per person per week")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--anchor", type=date.fromisoformat, default=None, help="feed 'today' (default: today)")
+    ap.add_argument("--repeat", type=int, default=3)
+    ap.add_argument("--pairs", type=int, default=20000, help="random pairs for the swap stage")
+    ap.add_argument("--traders", type=int, default=25, help="trader shifts for the trade_options stage")
+    ap.add_argument("--workers", type=int, default=None, help="all-pairs pool size")
+    ap.add_argument("--skip-all-pairs", action="store_true")
+    ap.add_argument("--out", help="write JSON here instead of stdout")
+    args = ap.parse_args(argv)
+
+    doc = run(args)
+    text = json.dumps(doc, indent=2)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,20 @@
+# gunicorn.conf.py
+"""
+Production server settings; gunicorn reads this file from the working
+directory (gunicorn app:app).
+
+Threaded workers are required: every open tab holds one /shifts/stream
+connection, and the default sync worker would give it a whole process. Each
+process serves at most SHIFT_STREAM_MAX_CLIENTS streams (tabs past that poll
+/shifts/delta), so keep `threads` well above that cap to leave room for
+/shifts.json and /trade-options.
+"""
+import os
+
+bind = os.environ.get("GUNICORN_BIND", "0.0.0.0:5002")
+workers = int(os.environ.get("GUNICORN_WORKERS", "2"))
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", "24"))
+timeout = 60
+# Open streams are cut after this on restart; browsers reconnect with Last-Event-ID
+graceful_timeout = 30